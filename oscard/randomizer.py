@@ -1,9 +1,7 @@
 from oslo.config import cfg
 from oscard import config
 from oscard.sim import collector
-import random
-
-bifrost = collector.get_fb_backend()
+import random, hashlib, struct
 
 random_opts = [
 	cfg.IntOpt(
@@ -16,15 +14,74 @@ random_opts = [
 CONF = cfg.CONF
 CONF.register_opts(random_opts)
 
+_UINT64 = struct.Struct('>Q')
+_2_53 = 1.0 / (1 << 53)
+
 def get_seed():
 	config.reload_conf(CONF)
 	seed = CONF.random_seed - 1
 	# -1 because simulation N
 	# will be run with seed N -1
-	return seed if seed >= 0 else bifrost.seed
+	return seed if seed >= 0 else collector.get_fb_backend().seed
 
-def get_randomizer():
-	seed = get_seed()
+def get_randomizer(seed=None):
+	if seed is None:
+		seed = get_seed()
 	r = random.Random()
 	r.seed(seed)
-	return r
\ No newline at end of file
+	return r
+
+def get_counter_randomizer(seed=None):
+	if seed is None:
+		seed = get_seed()
+	return CounterRandom(seed)
+
+class CounterRandom(object):
+	'''
+		A counter-based random generator.
+		Every number is a hash of (seed, step, proxy, purpose, n),
+		so the draws of a step don't depend on the ones of earlier steps:
+		they can be generated in any order, in bulk, by different workers,
+		or starting from any step, and they are always the same.
+	'''
+
+	def __init__(self, seed):
+		self.seed = seed
+
+	def random(self, step, proxy=0, purpose='', n=0):
+		'''
+			The n-th number in [0, 1) of (step, proxy, purpose).
+		'''
+		key = '%d:%d:%s:%s:%d' % (self.seed, step, proxy, purpose, n)
+		x, = _UINT64.unpack(hashlib.sha1(key).digest()[:8])
+		return (x >> 11) * _2_53
+
+	def choice(self, seq, step, proxy=0, purpose='', n=0):
+		return seq[int(self.random(step, proxy, purpose, n) * len(seq))]
+
+	def choices(self, seq, steps, proxy=0, purpose=''):
+		'''
+			A choice for each step in `steps`.
+		'''
+		return [self.choice(seq, t, proxy, purpose) for t in steps]
+
+	def stream(self, step, proxy=0, purpose=''):
+		'''
+			The draws of (step, proxy, purpose), one after the other,
+			with the `random.Random` methods used by commands.
+		'''
+		return _Stream(self, step, proxy, purpose)
+
+class _Stream(object):
+	def __init__(self, rng, step, proxy, purpose):
+		self._rng = rng
+		self._key = (step, proxy, purpose)
+		self._n = 0
+
+	def random(self):
+		x = self._rng.random(*self._key, n=self._n)
+		self._n += 1
+		return x
+
+	def choice(self, seq):
+		return seq[int(self.random() * len(seq))]
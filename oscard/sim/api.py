@@ -1,7 +1,9 @@
-import time
+import json, os, time, threading, Queue
+from multiprocessing.pool import ThreadPool
 from oslo.config import cfg
 from oscard import log
 from oscard import randomizer
+from oscard.sim import fakecloud, metrics
 
 oscard_opts = [
 	cfg.StrOpt(
@@ -29,6 +31,124 @@ oscard_opts = [
 		default='pwstack',
 		help='OpenStack password (make it match OS conf)'
 	),
+	cfg.FloatOpt(
+		name='hypervisor_cache_ttl',
+		default=2.0,
+		help='Seconds the hypervisors list is cached for (invalidated by every command)'
+	),
+	cfg.FloatOpt(
+		name='cpu_allocation_ratio',
+		default=16.0,
+		help='Virtual CPU to physical CPU allocation ratio (make it match OS conf)'
+	),
+	cfg.FloatOpt(
+		name='ram_allocation_ratio',
+		default=1.5,
+		help='Virtual RAM to physical RAM allocation ratio (make it match OS conf)'
+	),
+	cfg.FloatOpt(
+		name='disk_allocation_ratio',
+		default=1.0,
+		help='Virtual disk to physical disk allocation ratio (make it match OS conf)'
+	),
+	cfg.BoolOpt(
+		name='predict_saturation',
+		default=True,
+		help='Fail creates and resizes that fit on no hypervisor without running them '
+			'(see CapacityModel)'
+	),
+	cfg.ListOpt(
+		name='scheduler_default_filters',
+		default=[
+			'RetryFilter', 'AvailabilityZoneFilter', 'RamFilter', 'ComputeFilter',
+			'ComputeCapabilitiesFilter', 'ImagePropertiesFilter',
+			'ServerGroupAntiAffinityFilter', 'ServerGroupAffinityFilter'
+		],
+		help='Filters of the Nova scheduler (make it match OS conf): '
+			'CoreFilter, RamFilter and DiskFilter are the ones that predict_saturation checks'
+	),
+	cfg.IntOpt(
+		name='fake_hosts',
+		default=2,
+		help='Compute hosts of the fake cluster'
+	),
+	cfg.IntOpt(
+		name='fake_host_vcpus',
+		default=16,
+		help='vCPUs of each fake compute host'
+	),
+	cfg.IntOpt(
+		name='fake_host_memory_mb',
+		default=32768,
+		help='Memory (MB) of each fake compute host'
+	),
+	cfg.IntOpt(
+		name='fake_host_local_gb',
+		default=500,
+		help='Disk (GB) of each fake compute host'
+	),
+	cfg.ListOpt(
+		name='fake_host_profiles',
+		default=[],
+		help='Heterogeneous fake hosts, as count:vcpus:memory_mb:local_gb '
+			'(e.g. 4000:16:32768:500,1000:64:262144:2000). Overrides fake_host*'
+	),
+	cfg.FloatOpt(
+		name='fake_create_time',
+		default=5.0,
+		help='Virtual seconds a create takes on the fake cluster'
+	),
+	cfg.FloatOpt(
+		name='fake_resize_time',
+		default=10.0,
+		help='Virtual seconds a resize (and confirm) takes on the fake cluster'
+	),
+	cfg.FloatOpt(
+		name='fake_delete_time',
+		default=2.0,
+		help='Virtual seconds a delete takes on the fake cluster'
+	),
+	cfg.IntOpt(
+		name='max_in_flight',
+		default=10,
+		help='Commands run at the same time in open loop mode'
+	),
+	cfg.IntOpt(
+		name='max_queued_ops',
+		default=1000,
+		help='Commands waiting for a free slot in open loop mode, before rejecting new ones'
+	),
+	cfg.StrOpt(
+		name='nova_cache_file',
+		default='logs/nova_cache.json',
+		help='File where flavors and the image used by NovaAPI are cached'
+	),
+	cfg.FloatOpt(
+		name='nova_cache_ttl',
+		default=3600.0,
+		help='Seconds the cached flavors and image are valid for (0 disables the cache)'
+	),
+	cfg.IntOpt(
+		name='server_list_limit',
+		default=1000,
+		help='Servers asked for in each page of the server list '
+			'(not more than osapi_max_limit of Nova, the next page is read if a page is full)'
+	),
+	cfg.IntOpt(
+		name='teardown_concurrency',
+		default=20,
+		help='Deletes submitted to Nova at the same time by /teardown'
+	),
+	cfg.FloatOpt(
+		name='teardown_timeout',
+		default=600.0,
+		help='Seconds /teardown waits for deleted servers to disappear'
+	),
+	cfg.FloatOpt(
+		name='snapshot_stream_interval',
+		default=5.0,
+		help='Seconds between snapshots pushed to /snapshots subscribers when no command completes'
+	),
 ]
 
 CONF = cfg.CONF
@@ -46,16 +166,127 @@ def return_code(code):
 
 	return wrapped0
 
+class CommandError(Exception):
+	'''
+		A command failed on a known server.
+		`details` (e.g. the server id and flavor) are added to the error body.
+	'''
+	def __init__(self, message, **details):
+		Exception.__init__(self, message)
+		self.details = details
+
 def reraise_as_400(fun):
 	def wrapped(*args, **kwargs):
 		try:
 			return fun(*args, **kwargs)
 		except Exception as e:
-			return {'msg': e.message}, 400
+			body = {'msg': e.message}
+			body.update(getattr(e, 'details', {}))
+			return body, 400
+	return wrapped
+
+def timed_command(cmd):
+	'''
+		Records the latency of the command in the
+		`command_seconds` histogram (see `metrics`), by outcome.
+	'''
+	def wrapped0(fun):
+		def wrapped1(*args, **kwargs):
+			started_at = time.time()
+			body, status = fun(*args, **kwargs)
+			outcome = 'ok' if status < 400 else 'failed'
+			metrics.histogram('command_seconds', cmd=cmd, outcome=outcome).record(time.time() - started_at)
+			return body, status
+		return wrapped1
+
+	return wrapped0
+
+def timed_phase(cmd, phase):
+	return metrics.timed('command_phase_seconds', cmd=cmd, phase=phase)
+
+def notifies_listeners(fun):
+	'''
+		Calls the `listeners` of the api when the command
+		completes (or fails), e.g. to push a new snapshot.
+	'''
+	def wrapped(self, *args, **kwargs):
+		try:
+			return fun(self, *args, **kwargs)
+		finally:
+			for listener in self.listeners:
+				listener()
+	return wrapped
+
+def invalidates_hypervisors(fun):
+	def wrapped(self, *args, **kwargs):
+		try:
+			return fun(self, *args, **kwargs)
+		finally:
+			self.hypervisors.invalidate()
 	return wrapped
 
 class CRDAPI(object):
+	'''
+		Commands choose the flavor and the server at random,
+		unless `flavor_id` (create, resize) or `server_id` (resize, destroy)
+		is given. Results contain the server `id` (and `flavor_id`).
+
+		If the `step` (and `proxy`) of the simulation are given, random choices
+		depend only on them and on the seed (see `randomizer.CounterRandom`).
+
+		Commands can run concurrently (the proxy serves requests on
+		several threads): state shared by commands is guarded by `_lock`.
+	'''
 	_baseurl = 'http://localhost'
+	_generators = None
+
+	def _seed(self, seed=None):
+		'''
+			(Re)creates the random generators with `seed`,
+			or with the seed of the current simulation if None.
+			Returns the seed.
+		'''
+		if seed is None:
+			seed = randomizer.get_seed()
+		generators = (randomizer.get_randomizer(seed), randomizer.get_counter_randomizer(seed))
+		with self._lock:
+			self._generators = generators
+		return seed
+
+	# generators are created on first use:
+	# the seed of the current simulation comes from the backend
+	@property
+	def _rnd(self):
+		if self._generators is None:
+			self._seed()
+		return self._generators[0]
+
+	@property
+	def _counter_rnd(self):
+		if self._generators is None:
+			self._seed()
+		return self._generators[1]
+
+	def _rnd_for(self, purpose, step=None, proxy=None):
+		if step is None:
+			# random.Random draws are atomic
+			return self._rnd
+		return self._counter_rnd.stream(int(step), int(proxy or 0), purpose)
+
+	def _next_id(self):
+		with self._lock:
+			curr_id = self._curr_id
+			self._curr_id += 1
+			return curr_id
+
+	def now(self):
+		'''
+			The clock commands are timed with, in seconds.
+		'''
+		return time.time()
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
 
 	def create(self, **kwargs):
 		raise NotImplementedError
@@ -66,137 +297,834 @@ class CRDAPI(object):
 	def destroy(self, **kwargs):
 		raise NotImplementedError
 
-class FakeAPI(CRDAPI):
-	rnd = randomizer.get_randomizer()
+	def teardown(self, **kwargs):
+		raise NotImplementedError
 
-	def init(self, **kwargs):
-		self.rnd = randomizer.get_randomizer()
-		seed = randomizer.get_seed()
-		return {'seed': seed}, 200
+class OpenLoopRunner(object):
+	'''
+		Runs the commands of an api in open loop.
+		`submit` returns as soon as the command is queued,
+		at most `max_in_flight` commands are run at the same time (each one
+		blocking on its own thread) and the others wait in a queue.
+		Results are collected as commands finish and returned by `results`,
+		together with their queueing time and latency (in seconds).
+	'''
+	_COMMANDS = ('create', 'resize', 'destroy')
+
+	def __init__(self, api, max_in_flight=None, max_queued=None):
+		self._api = api
+		self.max_in_flight = max_in_flight or CONF.max_in_flight
+		self.max_queued = max_queued or CONF.max_queued_ops
+		self._queue = Queue.Queue()
+		self._lock = threading.Lock()
+		self._workers = []
+		self._done = []
+		self._next_id = 0
+		self._pending = 0
+
+	def _start_workers(self):
+		for i in xrange(self.max_in_flight):
+			th = threading.Thread(target=self._work, name='open-loop-' + str(i))
+			th.daemon = True
+			th.start()
+			self._workers.append(th)
+
+	def _work(self):
+		while True:
+			op_id, cmd, kwargs, submitted_at = self._queue.get()
+			started_at = time.time()
+			try:
+				body, status = getattr(self._api, cmd)(**kwargs)
+			except Exception as e:
+				body, status = {'msg': str(e)}, 400
+			finished_at = time.time()
+
+			result = {
+				'op_id': op_id,
+				'cmd': cmd,
+				'status': status,
+				'body': body,
+				'submitted_at': submitted_at,
+				'queue_time': started_at - submitted_at,
+				'latency': finished_at - started_at
+			}
 
-	def create(self, **kwargs):
-		payload = {}
-		status = 200
-		log_level = None
-		ok = bool(self.rnd.getrandbits(1))
-
-		if ok:
-			payload = {'id': self.rnd.randint(0, 1000), 'args': kwargs}
-			log_level = LOG.info
-		else:
-			status = 400
-			payload = {'msg': 'Random ERROR'}
-			log_level = LOG.error
+			with self._lock:
+				self._done.append(result)
+				self._pending -= 1
 
-		log_level('fakeapi: create --> ' + str(payload))
+	def submit(self, cmd, **kwargs):
+		if cmd not in self._COMMANDS:
+			return {'msg': 'Unknown command ' + str(cmd)}, 400
 
-		return payload, status
+		with self._lock:
+			if self._pending >= self.max_in_flight + self.max_queued:
+				return {'msg': 'Too many pending operations'}, 429
 
-	def resize(self, **kwargs):
-		payload = {}
-		status = 200
-		log_level = None
-		ok = bool(self.rnd.getrandbits(1))
-
-		if ok:
-			payload = {'body': 'resized', 'args': kwargs}
-			log_level = LOG.info
+			if not self._workers:
+				self._start_workers()
+
+			op_id = self._next_id
+			self._next_id += 1
+			self._pending += 1
+
+		self._queue.put((op_id, cmd, kwargs, time.time()))
+		return {'op_id': op_id}, 202
+
+	def results(self):
+		'''
+			Returns (and forgets) the results of commands finished
+			since the last call, and the number of pending ones.
+		'''
+		with self._lock:
+			done, self._done = self._done, []
+			pending = self._pending
+
+		return {'results': done, 'pending': pending}, 200
+
+class SnapshotBroadcaster(object):
+	'''
+		Pushes snapshots of an api to all of its subscribers.
+		A snapshot is taken when a command completes (register `notify`
+		as a listener of the api) or when `interval` seconds passed,
+		on a single thread: subscribers share the same fetch,
+		however many they are. No snapshot is taken without subscribers.
+	'''
+
+	def __init__(self, api, interval=None):
+		self._api = api
+		self.interval = interval or CONF.snapshot_stream_interval
+		self._cond = threading.Condition()
+		self._thread = None
+		self._subscribers = 0
+		self._dirty = False
+		self._seq = 0
+		self._event = None
+
+	def notify(self):
+		with self._cond:
+			self._dirty = True
+			self._cond.notify_all()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				deadline = time.time() + self.interval
+				while not self._subscribers or (not self._dirty and time.time() < deadline):
+					if not self._subscribers:
+						self._cond.wait()
+						deadline = time.time() + self.interval
+					else:
+						self._cond.wait(deadline - time.time())
+				# commands completing while fetching trigger a new fetch
+				self._dirty = False
+
+			metrics.counter('snapshot_stream_fetches_total').inc()
+			try:
+				snapshot, status = self._api.snapshot()
+			except Exception as e:
+				snapshot, status = {'msg': str(e)}, 400
+
+			if status >= 400:
+				LOG.error('snapshot stream: ' + str(snapshot.get('msg')))
+				continue
+
+			with self._cond:
+				self._seq += 1
+				self._event = {'seq': self._seq, 'time': time.time(), 'snapshot': snapshot}
+				self._cond.notify_all()
+
+	def subscribe(self):
+		'''
+			Yields a dict (`seq`, `time` and `snapshot`) for each new snapshot,
+			starting with a fresh one.
+		'''
+		with self._cond:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='snapshot-stream')
+				self._thread.daemon = True
+				self._thread.start()
+
+			self._subscribers += 1
+			self._dirty = True
+			seen = self._seq
+			self._cond.notify_all()
+
+		try:
+			while True:
+				with self._cond:
+					while self._seq == seen:
+						self._cond.wait()
+					seen, event = self._seq, self._event
+				yield event
+		finally:
+			with self._cond:
+				self._subscribers -= 1
+
+class _IndexedSet(object):
+	'''
+		A set with O(1) add, remove and random choice.
+	'''
+	def __init__(self):
+		self._items = []
+		self._pos = {}
+
+	def __len__(self):
+		return len(self._items)
+
+	def __iter__(self):
+		return iter(self._items)
+
+	def add(self, item):
+		if item not in self._pos:
+			self._pos[item] = len(self._items)
+			self._items.append(item)
+
+	def remove(self, item):
+		pos = self._pos.pop(item, None)
+		if pos is None:
+			return
+
+		# move the last item in the hole
+		last = self._items.pop()
+		if pos < len(self._items):
+			self._items[pos] = last
+			self._pos[last] = pos
+
+	def choice(self, rnd):
+		return self._items[int(rnd.random() * len(self._items))]
+
+class ServerInventory(object):
+	'''
+		In-memory inventory of the servers of the tenant, indexed by status.
+		Commands update it as they go, and it is reconciled
+		against the `servers.list()` results from time to time.
+		Random picks by status take constant time and no API call.
+
+		A picked server is busy until it is released (or removed):
+		it can't be picked again, so concurrent commands never
+		run on the same server.
+
+		Every change gets a new generation: a list requested at some
+		generation doesn't undo the changes made after it (see `reconcile`).
+	'''
+	def __init__(self):
+		self._servers = {}
+		self._statuses = {}
+		self._flavors = {}
+		self._busy = set()
+		self._idle = _IndexedSet()
+		self._by_status = {}
+		self._lock = threading.Lock()
+		self.reconciled_at = 0
+
+		self.generation = 0
+		self._changed = {} # generation of the last change of each server
+		self._removed = {} # generation each server was removed at
+		self._forgotten = 0 # removals up to this generation are forgotten
+
+	def __len__(self):
+		return len(self._statuses)
+
+	def _index(self, uid):
+		self._idle.add(uid)
+		self._by_status.setdefault(self._statuses[uid], _IndexedSet()).add(uid)
+
+	def _unindex(self, uid):
+		self._idle.remove(uid)
+		self._by_status[self._statuses[uid]].remove(uid)
+
+	def _set(self, server, status, flavor_id):
+		uid = server.id
+		if uid in self._statuses and uid not in self._busy:
+			self._unindex(uid)
+
+		self._servers[uid] = server
+		self._statuses[uid] = status
+		if flavor_id is not None:
+			try:
+				self._flavors[uid] = int(flavor_id)
+			except ValueError:
+				# not one of the default flavors (e.g. a UUID id)
+				self._flavors.pop(uid, None)
+
+		self.generation += 1
+		self._changed[uid] = self.generation
+
+		if uid not in self._busy:
+			self._index(uid)
+
+	def _remove(self, uid):
+		if uid not in self._statuses:
+			return
+
+		if uid in self._busy:
+			self._busy.discard(uid)
 		else:
-			status = 400
-			payload = {'msg': 'Random ERROR'}
-			log_level = LOG.error
+			self._unindex(uid)
 
-		log_level('fakeapi: resize --> ' + str(payload))
+		del self._statuses[uid]
+		del self._servers[uid]
+		self._flavors.pop(uid, None)
 
-		return payload, status
+		self.generation += 1
+		self._changed.pop(uid, None)
+		self._removed[uid] = self.generation
 
-	def destroy(self, **kwargs):
-		payload = {}
-		status = 200
-		log_level = None
-		ok = bool(self.rnd.getrandbits(1))
-
-		if ok:
-			payload = {'body': 'destroyed', 'args': kwargs}
-			log_level = LOG.info
+	def add(self, server, status, flavor_id=None):
+		'''
+			Adds a new server, busy until released.
+		'''
+		with self._lock:
+			self._busy.add(server.id)
+			self._set(server, status, flavor_id)
+
+	def release(self, server, status=None, flavor_id=None):
+		'''
+			Makes a busy server idle again.
+			If `status` is None, the last known status is kept.
+		'''
+		with self._lock:
+			uid = server.id
+			if uid not in self._statuses:
+				return
+
+			self._set(server, status or self._statuses[uid], flavor_id)
+			if uid in self._busy:
+				self._busy.discard(uid)
+				self._index(uid)
+
+	def remove(self, server_id):
+		with self._lock:
+			self._remove(server_id)
+
+	def flavor_id(self, server_id):
+		return self._flavors.get(server_id)
+
+	def ids(self, status=None):
+		with self._lock:
+			if status is None:
+				return self._statuses.keys()
+			return [uid for uid, st in self._statuses.items() if st == status]
+
+	def pick(self, rnd, status=None):
+		'''
+			Returns a random idle server with the given status (any if None),
+			or None if there is no such server. The server becomes busy.
+		'''
+		with self._lock:
+			candidates = self._idle if status is None else self._by_status.get(status)
+			if not candidates:
+				return None
+
+			uid = candidates.choice(rnd)
+			self._unindex(uid)
+			self._busy.add(uid)
+			return self._servers[uid]
+
+	def take_all(self):
+		'''
+			Like `pick`, for every idle server.
+		'''
+		with self._lock:
+			uids = list(self._idle)
+			for uid in uids:
+				self._unindex(uid)
+				self._busy.add(uid)
+			return [self._servers[uid] for uid in uids]
+
+	def take(self, server_id, status=None):
+		'''
+			Like `pick`, for a given server.
+			Returns None if the server is unknown, busy or not in `status`.
+		'''
+		with self._lock:
+			if server_id not in self._statuses or server_id in self._busy:
+				return None
+
+			if status is not None and self._statuses[server_id] != status:
+				return None
+
+			self._unindex(server_id)
+			self._busy.add(server_id)
+			return self._servers[server_id]
+
+	def reconcile(self, servers, since, complete=True):
+		'''
+			Updates the inventory with a `servers.list()` result,
+			requested when the inventory was at generation `since`:
+			servers added, changed or removed after it are left as they are.
+			If the list is `complete`, idle servers not in it are removed.
+		'''
+		with self._lock:
+			def changed(uid):
+				return self._changed.get(uid, 0) > since or self._removed.get(uid, 0) > since
+
+			listed = set()
+			for s in servers:
+				listed.add(s.id)
+				if changed(s.id):
+					continue
+				if s.id not in self._statuses and since < self._forgotten:
+					# it may have been removed, the next list will tell
+					continue
+				self._set(s, s.status, s.flavor['id'])
+
+			if complete:
+				gone = [uid for uid in self._idle if uid not in listed and not changed(uid)]
+				for uid in gone:
+					self._remove(uid)
+				self.reconciled_at = time.time()
+
+			# older lists can't re-add the servers removed up to `since`
+			self._removed = dict((uid, g) for uid, g in self._removed.items() if g > since)
+			self._forgotten = max(self._forgotten, since)
+
+class FakeAPI(CRDAPI):
+	'''
+		Runs commands on a `fakecloud.VirtualCluster`
+		(see `fake_*` options), no OpenStack node is needed.
+		Commands take virtual time only: `now` is the virtual clock
+		and `sleep` lets virtual time pass.
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.listeners = []
+		self._reset()
+
+	def _reset(self):
+		self._curr_id = 0
+		self.inventory = ServerInventory()
+
+		self.cluster = fakecloud.VirtualCluster(
+			self._fake_hosts(),
+			durations={
+				'create': CONF.fake_create_time,
+				'resize': CONF.fake_resize_time,
+				'delete': CONF.fake_delete_time,
+			},
+			cpu_ratio=CONF.cpu_allocation_ratio,
+			ram_ratio=CONF.ram_allocation_ratio,
+			disk_ratio=CONF.disk_allocation_ratio
+		)
+
+	def _fake_hosts(self):
+		if not CONF.fake_host_profiles:
+			host = (CONF.fake_host_vcpus, CONF.fake_host_memory_mb, CONF.fake_host_local_gb)
+			return [host] * CONF.fake_hosts
+
+		hosts = []
+		for profile in CONF.fake_host_profiles:
+			count, vcpus, memory_mb, local_gb = [int(x) for x in profile.split(':')]
+			hosts += [(vcpus, memory_mb, local_gb)] * count
+		return hosts
+
+	@reraise_as_400
+	@return_code(200)
+	def init(self, seed=None, **kwargs):
+		'''
+			Every simulation starts on an empty cluster.
+		'''
+		seed = self._seed(seed)
+		with self._lock:
+			self._reset()
+		LOG.debug('FakeAPI inited with seed ' + str(seed))
+		return {'seed': seed}
+
+	def now(self):
+		return self.cluster.clock
+
+	def sleep(self, seconds):
+		self.cluster.wait(seconds)
+
+	def _get_server(self, server_id=None, status=None, rnd=None):
+		if server_id is None:
+			server = self.inventory.pick(rnd or self._rnd, status=status)
+			if server is None:
+				raise Exception('No ' + (status + ' ' if status else '') + 'server found')
 		else:
-			status = 400
-			payload = {'msg': 'Random ERROR'}
-			log_level = LOG.error
+			server = self.inventory.take(server_id, status=status)
+			if server is None:
+				raise Exception('Server ' + str(server_id) + ' not available')
+		return server
+
+	@timed_command('create')
+	@reraise_as_400
+	@return_code(201)
+	@notifies_listeners
+	def create(self, flavor_id=None, step=None, proxy=None, **kwargs):
+		if flavor_id is None:
+			flavor_id = self._rnd_for('flavor', step, proxy).choice(self.cluster.flavors.keys())
+		flavor_id = int(flavor_id)
+		server_id = 'fake' + str(self._next_id())
 
-		log_level('fakeapi: destroy --> ' + str(payload))
+		try:
+			server = self.cluster.create(server_id, flavor_id)
+		except fakecloud.NoValidHost as e:
+			# the server is there, in ERROR status
+			server = self.cluster.servers[server_id]
+			self.inventory.add(server, server.status, flavor_id=flavor_id)
+			self.inventory.release(server)
+			raise CommandError(e.message, id=server_id, flavor_id=flavor_id)
+
+		self.inventory.add(server, server.status, flavor_id=flavor_id)
+		self.inventory.release(server)
+		LOG.info('fakeapi: create --> ' + server_id + ' at ' + str(self.cluster.clock))
+		return {'id': server_id, 'flavor_id': flavor_id}
+
+	@timed_command('resize')
+	@reraise_as_400
+	@return_code(200)
+	@notifies_listeners
+	def resize(self, server_id=None, flavor_id=None, step=None, proxy=None, **kwargs):
+		server = self._get_server(server_id, status='ACTIVE', rnd=self._rnd_for('server', step, proxy))
 
-		return payload, status
+		if flavor_id is None:
+			flavors_ok = self.cluster.flavors.keys()
+			flavors_ok.remove(server.flavor_id)
+			flavor_id = self._rnd_for('flavor', step, proxy).choice(flavors_ok)
+		flavor_id = int(flavor_id)
 
+		try:
+			if flavor_id == server.flavor_id:
+				raise Exception('Server ' + server.id + ' has already flavor ' + str(flavor_id))
+			self.cluster.resize(server.id, flavor_id)
+		except fakecloud.NoValidHost as e:
+			raise CommandError(e.message, id=server.id, flavor_id=flavor_id)
+		finally:
+			self.inventory.release(server, server.status, flavor_id=server.flavor_id)
+
+		LOG.info('fakeapi: resize --> ' + server.id + ' at ' + str(self.cluster.clock))
+		return {'id': server.id, 'flavor_id': flavor_id}
+
+	@timed_command('destroy')
+	@reraise_as_400
+	@return_code(200)
+	@notifies_listeners
+	def destroy(self, server_id=None, step=None, proxy=None, **kwargs):
+		server = self._get_server(server_id, rnd=self._rnd_for('server', step, proxy))
+
+		self.cluster.delete(server.id)
+		self.inventory.remove(server.id)
+		LOG.info('fakeapi: destroy --> ' + server.id + ' at ' + str(self.cluster.clock))
+		return {'id': server.id}
+
+	@timed_command('teardown')
+	@reraise_as_400
+	@return_code(200)
+	@notifies_listeners
+	def teardown(self, **kwargs):
+		'''
+			Destroys every server that is not busy.
+		'''
+		servers = self.inventory.take_all()
+		for server in servers:
+			self.cluster.delete(server.id)
+			self.inventory.remove(server.id)
+
+		LOG.info('fakeapi: teardown --> ' + str(len(servers)) + ' servers at ' + str(self.cluster.clock))
+		return {'deleted': len(servers), 'failed': []}
+
+	@return_code(200)
 	def active_services(self):
-		services = ['fakeservice1', 'fakeservice2']
+		services = [
+			('nova-compute', len(self.cluster.hosts)),
+			('nova-scheduler', 1),
+			('nova-conductor', 1),
+		]
 		data = {}
-		for i, s in enumerate(services):
+		for i, (s, n) in enumerate(services):
 			data[i] = {
 				'binary': s,
-				'n': self.rnd.randint(1, 42)
+				'n': n
 			}
 
-		return data, 200
+		return data
 
 	@property
+	@return_code(200)
 	def architecture(self):
-		arch = {}
-		arch[0] = {
-			'hostname': 'fakehost0',
-			'address': '42.42.42.2',
-			'vcpus': '??',
-			'memory_mb': '??',
-			'local_gb': '??',
-		}
+		return self.cluster.architecture()
 
-		arch[1] = {
-			'hostname': 'fakehost1',
-			'address': '42.42.42.4',
-			'vcpus': '??',
-			'memory_mb': '??',
-			'local_gb': '??',
-		}
+	@return_code(200)
+	def snapshot(self):
+		return self.cluster.snapshot()
 
-		return arch, 200
+from keystoneclient.v2_0 import client as ksclient
+from novaclient.v1_1 import client as nvclient
+from novaclient.v1_1 import flavors as nvflavors, images as nvimages
+from novaclient.exceptions import NotFound
 
-	def snapshot(self):
-		metrics = {
-			'vcpus_used': '?',
-			'memory_mb_used': '?',
-			'local_gb_used': '?',
-			'r_vcpus': '?',
-			'r_memory_mb': '?',
-			'r_local_gb': '?'
-		}
+def _load_cache(path, ttl, key):
+	'''
+		The data stored by `_store_cache` for `key`,
+		or None if there is none, or it's older than `ttl` seconds.
+	'''
+	if ttl <= 0 or not os.path.exists(path):
+		return None
 
-		hosts = {}
+	try:
+		with open(path) as f:
+			cache = json.load(f)
+	except Exception as e:
+		LOG.warning('Ignoring cache ' + path + ': ' + str(e))
+		return None
 
-		metrics['hostname'] = 'fakehost0'
-		metrics['address'] = '42.42.42.2'
-		hosts[0] = metrics
-		metrics['hostname'] = 'fakehost1'
-		metrics['address'] = '42.42.42.4'
-		hosts[1] = metrics
+	if cache.get('key') != key or time.time() - cache.get('stored_at', 0) > ttl:
+		return None
+	return cache['data']
+
+def _store_cache(path, ttl, key, data):
+	if ttl <= 0:
+		return
+
+	try:
+		# written aside and renamed, a proxy starting
+		# at the same time never reads half of it
+		tmp = path + '.' + str(os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'key': key, 'stored_at': time.time(), 'data': data}, f)
+		os.rename(tmp, path)
+	except Exception as e:
+		LOG.warning('Cannot cache in ' + path + ': ' + str(e))
+
+class HypervisorCache(object):
+	'''
+		Caches the result of `hypervisors.list()` for `ttl` seconds.
+		Concurrent callers share a single in-flight request.
+		`invalidate` makes the next `get` fetch the list again
+		(the result of a request in flight while invalidating is discarded).
+	'''
+	def __init__(self, nova, ttl):
+		self._nova = nova
+		self.ttl = ttl
+		self._cond = threading.Condition()
+		self._hosts = None
+		self._fetched_at = 0
+		self._fetching = False
+		self._generation = 0
+		self._completed = 0
+
+	def get(self):
+		with self._cond:
+			seen = self._completed
+			while True:
+				if self._hosts is not None:
+					if self._completed > seen or time.time() - self._fetched_at < self.ttl:
+						metrics.counter('hypervisor_cache_total', result='hit').inc()
+						return self._hosts
+
+				if not self._fetching:
+					break
+
+				self._cond.wait()
+
+			self._fetching = True
+			generation = self._generation
+			metrics.counter('hypervisor_cache_total', result='miss').inc()
+
+		hosts = None
+		try:
+			hosts = self._nova.hypervisors.list()
+			return hosts
+		finally:
+			with self._cond:
+				self._fetching = False
+				if hosts is not None and generation == self._generation:
+					self._hosts = hosts
+					self._fetched_at = time.time()
+					self._completed += 1
+				self._cond.notify_all()
+
+	def invalidate(self):
+		with self._cond:
+			self._hosts = None
+			self._generation += 1
+
+class CapacityModel(object):
+	'''
+		Predicts if a flavor fits on some hypervisor as the filter
+		scheduler would, from the capacity and the usage of hypervisors:
+		Nova would fail with 'No valid host' otherwise.
+		Only the resources of the given filters are checked (CoreFilter,
+		RamFilter and DiskFilter, with the `*_allocation_ratio` options).
+		Flavors are Nova flavors (by id), hosts Nova hypervisors.
+	'''
+	def __init__(self, flavors, filters, cpu_ratio, ram_ratio, disk_ratio):
+		self.flavors = flavors
+		self.filters = set(filters)
+		self.cpu_ratio = cpu_ratio
+		self.ram_ratio = ram_ratio
+		self.disk_ratio = disk_ratio
+
+	def _fits(self, host, flavor, freed=None):
+		vcpus, ram, disk = host.vcpus_used, host.memory_mb_used, host.local_gb_used
+		if freed is not None:
+			vcpus -= freed.vcpus
+			ram -= freed.ram
+			disk -= freed.disk
+
+		if 'CoreFilter' in self.filters and vcpus + flavor.vcpus > host.vcpus * self.cpu_ratio:
+			return False
+		if 'RamFilter' in self.filters and ram + flavor.ram > host.memory_mb * self.ram_ratio:
+			return False
+		if 'DiskFilter' in self.filters and disk + flavor.disk > host.local_gb * self.disk_ratio:
+			return False
+		return True
+
+	def fits(self, hosts, flavor_id, freed_flavor_id=None):
+		'''
+			True if the flavor fits on at least one of the hosts.
+			For resizes, `freed_flavor_id` is the flavor of the server: we don't
+			know its host, so it is considered freed on every host (if the
+			flavor doesn't fit even so, the resize fails for sure).
+		'''
+		flavor = self.flavors[int(flavor_id)]
+		freed = None if freed_flavor_id is None else self.flavors[int(freed_flavor_id)]
+		return any(self._fits(h, flavor, freed) for h in hosts)
 
-		return {
-			'cmps': hosts,
-			'avg_r_vcpus' : 0,
-			'avg_r_memory_mb' : 0,
-			'avg_r_local_gb' : 0,
-			'no_active_cmps': 2
-		}, 200
+	def saturated(self, hosts):
+		'''
+			True if no flavor fits on any host: every create would fail.
+		'''
+		return not any(self.fits(hosts, i) for i in self.flavors)
+
+class _Watch(object):
+	def __init__(self, wanted, failures, deadline):
+		self.wanted = wanted
+		self.failures = failures
+		self.deadline = deadline
+		self.status = None
+		self.event = threading.Event()
+
+	def resolve(self, status):
+		self.status = status
+		self.event.set()
+
+class StatusPoller(object):
+	'''
+		Waits for servers to reach a status.
+		A single thread resolves the status of every watched server
+		with one `servers.list()` call per polling interval, and wakes up
+		the waiting threads. Deadlines are in seconds (wall-clock).
+
+		Servers that are no more in the list have status DELETED.
+		The list is read a page of `list_limit` servers at a time (it must
+		not exceed `osapi_max_limit` of Nova): a single call if they all fit.
+
+		Every list is also used to reconcile the `inventory`, if given.
+	'''
+	DELETED_STATUS = 'DELETED'
+
+	def __init__(self, nova, poll_time, inventory=None, list_limit=None):
+		self._nova = nova
+		self.poll_time = poll_time
+		self.list_limit = list_limit or CONF.server_list_limit
+		self._inventory = inventory
+		self._watches = {}
+		self._cond = threading.Condition()
+		self._thread = None
+
+	def wait(self, server_id, wanted_status, timeout, failure_statuses=('ERROR', )):
+		'''
+			Blocks until the server reaches `wanted_status`,
+			or one of `failure_statuses`, or `timeout` seconds are passed.
+			Returns the status reached, or TIMEOUT_EXCEEDED.
+		'''
+		return self.wait_all([server_id], wanted_status, timeout, failure_statuses)[server_id]
+
+	def wait_all(self, server_ids, wanted_status, timeout, failure_statuses=('ERROR', )):
+		'''
+			Like `wait`, for many servers at once: all of them are resolved
+			by the same polls. Returns a dict with the status of each server.
+		'''
+		deadline = time.time() + timeout
+		watches = dict((uid, _Watch(wanted_status, failure_statuses, deadline)) for uid in server_ids)
+
+		with self._cond:
+			for uid, watch in watches.items():
+				self._watches.setdefault(uid, []).append(watch)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='status-poller')
+				self._thread.daemon = True
+				self._thread.start()
+			self._cond.notify()
+
+		for watch in watches.values():
+			watch.event.wait()
+		return dict((uid, watch.status) for uid, watch in watches.items())
+
+	def list_servers(self):
+		'''
+			Every server of the tenant, with a call for each page of the list
+			(a page shorter than `list_limit` is the last one).
+		'''
+		servers = self._nova.servers.list(detailed=True, limit=self.list_limit)
+		page = servers
+		while len(page) >= self.list_limit:
+			page = self._nova.servers.list(detailed=True, marker=page[-1].id, limit=self.list_limit)
+			servers += page
+		return servers
+
+	def _statuses(self, ids):
+		since = self._inventory.generation if self._inventory is not None else None
+		servers = self.list_servers()
+		statuses = dict((s.id, s.status) for s in servers)
+
+		if self._inventory is not None:
+			self._inventory.reconcile(servers, since)
+
+		for uid in ids:
+			statuses.setdefault(uid, self.DELETED_STATUS)
+		return statuses
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._watches:
+					self._cond.wait()
+				ids = self._watches.keys()
+
+			metrics.counter('status_polls_total').inc()
+			try:
+				statuses = self._statuses(ids)
+			except Exception as e:
+				metrics.counter('status_poll_errors_total').inc()
+				LOG.error('status poller: ' + str(e))
+				statuses = {}
+
+			now = time.time()
+			with self._cond:
+				for uid in self._watches.keys():
+					status = statuses.get(uid)
+					pending = []
+					for w in self._watches[uid]:
+						if status == w.wanted or status in w.failures:
+							w.resolve(status)
+						elif now >= w.deadline:
+							metrics.counter('status_timeouts_total', wanted=w.wanted).inc()
+							w.resolve(NovaAPI._TIMEOUT_EXCEEDED_STATUS)
+						else:
+							pending.append(w)
+
+					if pending:
+						self._watches[uid] = pending
+					else:
+						del self._watches[uid]
+
+			time.sleep(self.poll_time)
 
-from keystoneclient.v2_0 import client as ksclient
-from novaclient.v1_1 import client as nvclient
-from novaclient.exceptions import NotFound
 class NovaAPI(CRDAPI):
 	_baseurl = 'http://' + CONF.ctrl_host
 	_instance_basename = 'fake'
-	_TIMEOUT = 20 # preventing deadlocks
+	_TIMEOUT = 20 # seconds, preventing deadlocks
 	_POLL_TIME = 0.5 # polling time
+	_RECONCILE_TIME = 60 # seconds between inventory reconciliations
 	# statuses
+	_BUILD_STATUS = 'BUILD'
 	_ACTIVE_STATUS = 'ACTIVE'
+	_RESIZE_STATUS = 'RESIZE'
 	_VERIFY_RESIZE_STATUS = 'VERIFY_RESIZE'
 	_ERROR_STATUS = 'ERROR'
 	_TIMEOUT_EXCEEDED_STATUS = 'TIMEOUT_EXCEEDED'
@@ -222,25 +1150,17 @@ class NovaAPI(CRDAPI):
 	@property
 	@reraise_as_400
 	def server_ids(self):
-		servers = self.nova.servers.list()
-		return [s.id for s in servers]
+		return self.inventory.ids()
 
 	@property
 	@reraise_as_400
 	@return_code(200)
 	def architecture(self):
 		arch = {}
-		cmps = self.nova.hypervisors.list()
+		cmps = self.hypervisors.get()
 
 		for c in cmps:
-			# update known cmps.
-			# append new ones at the end of the list.
-			# in this way a cmp will always be in the same position of the list.
-			if not c.host_ip in self._known_cmps:
-				self._known_cmps.append(c.host_ip)
-
-			cmp_index = self._known_cmps.index(c.host_ip)
-			arch[cmp_index] = {
+			arch[self._cmp_index(c.host_ip)] = {
 				'hostname': c.hypervisor_hostname,
 				'address': c.host_ip,
 				'vcpus': c.vcpus,
@@ -251,180 +1171,359 @@ class NovaAPI(CRDAPI):
 		return arch
 	
 	def __init__(self):
-		self._rnd = randomizer.get_randomizer()
+		self._lock = threading.Lock()
+		self.listeners = []
 		self._curr_id = 0
 		self._os_auth_url = self._baseurl + ':' + str(CONF.keystone_port) + '/v2.0'
 		self._os_username = CONF.os_username
 		self._os_password = CONF.os_password
 		self._os_tenant_name = CONF.os_tenant
 
-		self.keystone = ksclient.Client(**self.kcreds)
+		self._keystone = None
 		self.nova = nvclient.Client(**self.ncreds)
 
-		cmps = self.nova.hypervisors.list()
-		self._known_cmps = [c.host_ip for c in cmps] 
-
-		# assigning to self.image the first cirros image
-		# or the first image possible
-		images = self.nova.images.list()
-		self.image = images[0]
-		for img in images:
-			if img.name.startswith('cirros'):
-				self.image = img
-				break
-
-		# assigning all 5 flavors
-		self.flavors = {}
-		for i in xrange(1, 6):
-			self.flavors[i] = self.nova.flavors.get(i)
-
-	def _until_timeout(self, server, wanted_status='ACTIVE'):
-		waiting_time = 0
-		status = server.status
-		while status != wanted_status and waiting_time < self._TIMEOUT:
-			if status == self._ERROR_STATUS:
-				break
+		# latencies of Nova API calls (see /metrics)
+		metrics.instrument(self.nova.servers, 'servers',
+			('list', 'get', 'create', 'delete', 'resize', 'confirm_resize'))
+		metrics.instrument(self.nova.hypervisors, 'hypervisors', ('list', ))
+		metrics.instrument(self.nova.flavors, 'flavors', ('get', 'list'))
+		metrics.instrument(self.nova.images, 'images', ('list', ))
+		metrics.instrument(self.nova.services, 'services', ('list', ))
+		self.inventory = ServerInventory()
+		self.poller = StatusPoller(self.nova, self._POLL_TIME, inventory=self.inventory)
+		self.hypervisors = HypervisorCache(self.nova, CONF.hypervisor_cache_ttl)
+
+		# these calls don't depend on each other
+		pool = ThreadPool(3)
+		try:
+			reconciled = pool.apply_async(self.reconcile)
+			cmps = pool.apply_async(self.hypervisors.get)
+			flavors_and_image = pool.apply_async(self._get_flavors_and_image)
+
+			reconciled.get()
+			self._known_cmps = [c.host_ip for c in cmps.get()]
+			self.flavors, self.image = flavors_and_image.get()
+		finally:
+			pool.close()
+
+		self.capacity = CapacityModel(
+			self.flavors,
+			CONF.scheduler_default_filters,
+			CONF.cpu_allocation_ratio,
+			CONF.ram_allocation_ratio,
+			CONF.disk_allocation_ratio
+		)
 
-			time.sleep(self._POLL_TIME)
-			waiting_time += 1
-			# Retrieve the instance again so the status field updates
-			server = self.nova.servers.get(server.id)
-			status = server.status
+	@property
+	def keystone(self):
+		# it authenticates when created, and nothing uses it on startup
+		if self._keystone is None:
+			self._keystone = ksclient.Client(**self.kcreds)
+		return self._keystone
 
-		if waiting_time == self._TIMEOUT:
-			status = self._TIMEOUT_EXCEEDED_STATUS
+	def _get_flavors_and_image(self):
+		'''
+			The 5 default flavors (by id) and the image servers are created
+			with (the first cirros image, or the first image possible).
+			They are listed with a call each, and cached on disk
+			(see `nova_cache_*` options).
+		'''
+		key = self._os_auth_url + ' ' + self._os_tenant_name
+		cached = _load_cache(CONF.nova_cache_file, CONF.nova_cache_ttl, key)
+
+		if cached is None:
+			flavors = dict((str(f.id), f) for f in self.nova.flavors.list())
+			for i in xrange(1, 6):
+				if str(i) not in flavors:
+					# not public
+					flavors[str(i)] = self.nova.flavors.get(i)
+
+			images = self.nova.images.list()
+			image = images[0]
+			for img in images:
+				if img.name.startswith('cirros'):
+					image = img
+					break
+
+			cached = {
+				'flavors': dict((str(i), flavors[str(i)]._info) for i in xrange(1, 6)),
+				'image': image._info
+			}
+			_store_cache(CONF.nova_cache_file, CONF.nova_cache_ttl, key, cached)
 
-		return status
+		flavors = dict(
+			(int(i), nvflavors.Flavor(self.nova.flavors, info, loaded=True))
+			for i, info in cached['flavors'].items()
+		)
+		return flavors, nvimages.Image(self.nova.images, cached['image'], loaded=True)
 
-	def _get_random_server(self, status=None):
-		ids = list(self.server_ids) #copy ids
+	def _cmp_index(self, host_ip):
+		'''
+			Known cmps are kept in a list, new ones are appended at its end:
+			a cmp is always in the same position, that is its unique ID.
+		'''
+		with self._lock:
+			if not host_ip in self._known_cmps:
+				self._known_cmps.append(host_ip)
+			return self._known_cmps.index(host_ip)
 
-		if len(ids) == 0:
-			return None
+	def _until_timeout(self, server, wanted_status='ACTIVE'):
+		return self.poller.wait(server.id, wanted_status, self._TIMEOUT)
 
-		uid = self._rnd.choice(ids)
-		server = self.nova.servers.get(uid)
+	def reconcile(self):
+		'''
+			Reconciles the inventory with the servers known by Nova.
+			Returns the number of servers.
+		'''
+		since = self.inventory.generation
+		servers = self.poller.list_servers()
+		self.inventory.reconcile(servers, since)
+		return len(servers)
 
-		if status is None:
-			return server
+	def _get_random_server(self, status=None, rnd=None):
+		'''
+			The server returned is busy in the inventory,
+			release it (or remove it) when done.
+		'''
+		if time.time() - self.inventory.reconciled_at > self._RECONCILE_TIME:
+			self.reconcile()
 
-		while len(ids) > 0 and server.status != status:
-			ids.remove(uid)
-			uid = self._rnd.choice(ids)
-			server = self.nova.servers.get(uid)
+		return self.inventory.pick(rnd or self._rnd, status=status)
 
-		if server.status == status:
-			return server
-		return None
+	def _get_server(self, server_id=None, status=None, rnd=None):
+		'''
+			The given server (or a random one), busy in the inventory.
+		'''
+		if server_id is None:
+			server = self._get_random_server(status=status, rnd=rnd)
+			if server is None:
+				raise Exception('No ' + (status + ' ' if status else '') + 'server found')
+		else:
+			server = self.inventory.take(server_id, status=status)
+			if server is None:
+				raise Exception('Server ' + str(server_id) + ' not available')
+		return server
 
 	@reraise_as_400
 	@return_code(200)
-	def init(self, **kwargs):
-		self._rnd = randomizer.get_randomizer()
-		seed = randomizer.get_seed()
+	def init(self, seed=None, **kwargs):
+		seed = self._seed(seed)
 		LOG.debug('NovaAPI inited with seed ' + str(seed))
 		return {'seed': seed}
 
+	@timed_command('create')
 	@reraise_as_400
 	@return_code(201)
-	def create(self, **kwargs):
+	@notifies_listeners
+	@invalidates_hypervisors
+	def create(self, flavor_id=None, step=None, proxy=None, **kwargs):
 		'''
 			Creates a new instance.
 			This call is blocking untill the instance reaches an ACTIVE status,
 			or fails
 		'''
-		flavor_id = self._rnd.choice(self.flavors.keys())
+		if flavor_id is None:
+			flavor_id = self._rnd_for('flavor', step, proxy).choice(self.flavors.keys())
+		flavor_id = int(flavor_id)
 		flavor = self.flavors[flavor_id]
 
-		server = self.nova.servers.create(
-			name=self._instance_basename + str(self._curr_id),
-			image=self.image,
-			flavor=flavor
-		)
+		if CONF.predict_saturation and not self.capacity.fits(self.hypervisors.get(), flavor_id):
+			# Nova would fail, after the scheduler has run
+			metrics.counter('predicted_no_valid_host_total', cmd='create').inc()
+			raise CommandError(fakecloud.NO_VALID_HOST, flavor_id=flavor_id)
 
-		status = self._until_timeout(server)
+		# concurrent creates get different names
+		name = self._instance_basename + str(self._next_id())
+		with timed_phase('create', 'submit'):
+			server = self.nova.servers.create(
+				name=name,
+				image=self.image,
+				flavor=flavor
+			)
+		self.inventory.add(server, self._BUILD_STATUS, flavor_id=flavor_id)
+
+		with timed_phase('create', 'wait'):
+			status = self._until_timeout(server)
 
 		if status == self._TIMEOUT_EXCEEDED_STATUS:
-			raise Exception('timeout exceeded on create')
-		
+			self.inventory.release(server)
+			raise CommandError('timeout exceeded on create', id=server.id, flavor_id=flavor_id)
+
+		self.inventory.release(server, status)
+
 		if status == self._ACTIVE_STATUS:
 			# ok the machine is up
-			self._curr_id += 1
-			return {'id': server.id}
+			return {'id': server.id, 'flavor_id': flavor_id}
 
 		# there was a failure in OpenStack
 		server = self.nova.servers.get(server.id)
-		raise Exception(server.fault.get('message', ''))
+		raise CommandError(server.fault.get('message', ''), id=server.id, flavor_id=flavor_id)
 
+	@timed_command('resize')
 	@reraise_as_400
 	@return_code(200)
-	def resize(self, **kwargs):
+	@notifies_listeners
+	@invalidates_hypervisors
+	def resize(self, server_id=None, flavor_id=None, step=None, proxy=None, **kwargs):
 		'''
 			Blocking call untill the resize has been confirmed
 			and the instance is in status ACTIVE
 		'''
 		
-		server = self._get_random_server(status=self._ACTIVE_STATUS)
-
-		if server is None:
-			raise Exception('No ACTIVE server found')
+		server = self._get_server(server_id, status=self._ACTIVE_STATUS, rnd=self._rnd_for('server', step, proxy))
 
-		# remove the already chosen flavor from
-		# flavors ids
-		flavors_ok = self.flavors.keys()
-		flavors_ok.remove(int(server.flavor['id']))
-		flavor_id = self._rnd.choice(flavors_ok)
+		try:
+			old_flavor_id = self.inventory.flavor_id(server.id)
 
-		flavor = self.flavors[flavor_id]
-		server.resize(flavor)
+			if flavor_id is None:
+				# remove the already chosen flavor from
+				# flavors ids (unless it is not a default one)
+				flavors_ok = [f for f in self.flavors.keys() if f != old_flavor_id]
+				flavor_id = self._rnd_for('flavor', step, proxy).choice(flavors_ok)
+			flavor_id = int(flavor_id)
 
-		status = self._until_timeout(server, wanted_status='VERIFY_RESIZE')
+			if flavor_id == old_flavor_id:
+				raise Exception('Server ' + server.id + ' has already flavor ' + str(flavor_id))
 
-		if status == self._TIMEOUT_EXCEEDED_STATUS:
-			raise Exception('timeout exceeded on resize')
+			if CONF.predict_saturation and old_flavor_id is not None and \
+					not self.capacity.fits(self.hypervisors.get(), flavor_id, freed_flavor_id=old_flavor_id):
+				metrics.counter('predicted_no_valid_host_total', cmd='resize').inc()
+				raise CommandError(fakecloud.NO_VALID_HOST, id=server.id, flavor_id=flavor_id)
 
-		if status == self._ERROR_STATUS:
-			server = self.nova.servers.get(server.id)
-			raise Exception(server.fault.get('message', ''))
+			flavor = self.flavors[flavor_id]
+			with timed_phase('resize', 'submit'):
+				server.resize(flavor)
 
-		server.confirm_resize()
+			with timed_phase('resize', 'wait'):
+				status = self._until_timeout(server, wanted_status=self._VERIFY_RESIZE_STATUS)
 
-		status = self._until_timeout(server)
+			if status == self._TIMEOUT_EXCEEDED_STATUS:
+				self.inventory.release(server, self._RESIZE_STATUS)
+				raise CommandError('timeout exceeded on resize', id=server.id, flavor_id=flavor_id)
 
-		if status == self._TIMEOUT_EXCEEDED_STATUS:
-			raise Exception('timeout exceeded on confirm_resize')
+			if status == self._ERROR_STATUS:
+				self.inventory.release(server, status)
+				server = self.nova.servers.get(server.id)
+				raise CommandError(server.fault.get('message', ''), id=server.id, flavor_id=flavor_id)
 
-		if status == self._ERROR_STATUS:
-			server = self.nova.servers.get(server.id)
-			raise Exception(server.fault.get('message', ''))
+			with timed_phase('resize', 'confirm'):
+				server.confirm_resize()
+				status = self._until_timeout(server)
 
-		return {'id': server.id}
+			if status == self._TIMEOUT_EXCEEDED_STATUS:
+				self.inventory.release(server, self._VERIFY_RESIZE_STATUS)
+				raise CommandError('timeout exceeded on confirm_resize', id=server.id, flavor_id=flavor_id)
 
+			if status == self._ERROR_STATUS:
+				self.inventory.release(server, status)
+				server = self.nova.servers.get(server.id)
+				raise CommandError(server.fault.get('message', ''), id=server.id, flavor_id=flavor_id)
+		except Exception:
+			# whatever fails, the server must not stay busy
+			# (releasing it again is harmless)
+			self.inventory.release(server)
+			raise
+
+		self.inventory.release(server, status, flavor_id=flavor_id)
+		return {'id': server.id, 'flavor_id': flavor_id}
+
+	@timed_command('destroy')
 	@reraise_as_400
 	@return_code(200)
-	def destroy(self, **kwargs):
-		server = self._get_random_server()
+	@notifies_listeners
+	@invalidates_hypervisors
+	def destroy(self, server_id=None, step=None, proxy=None, **kwargs):
+		server = self._get_server(server_id, rnd=self._rnd_for('server', step, proxy))
+
+		try:
+			with timed_phase('destroy', 'submit'):
+				server.delete()
+		except NotFound:
+			# already gone
+			self.inventory.remove(server.id)
+			raise
+		except Exception:
+			self.inventory.release(server)
+			raise
+
+		# an ERROR server can be deleted too,
+		# so we only wait for it to disappear
+		with timed_phase('destroy', 'wait'):
+			status = self.poller.wait(
+				server.id,
+				StatusPoller.DELETED_STATUS,
+				self._TIMEOUT,
+				failure_statuses=()
+			)
 
-		if server is None:
-			raise Exception('No server found')
+		if status == self._TIMEOUT_EXCEEDED_STATUS:
+			self.inventory.release(server)
+			raise CommandError('timeout exceeded on delete', id=server.id)
 
-		server.delete()
+		self.inventory.remove(server.id)
+		return {'id': server.id}
+
+	@timed_command('teardown')
+	@reraise_as_400
+	@return_code(200)
+	@notifies_listeners
+	@invalidates_hypervisors
+	def teardown(self, concurrency=None, **kwargs):
+		'''
+			Deletes every server of the tenant that is not busy.
+			At most `concurrency` (`teardown_concurrency` if None) deletes
+			are submitted at the same time, then all of them are waited for
+			with the same status polls (see `StatusPoller.wait_all`).
+		'''
+		self.reconcile()
+		servers = self.inventory.take_all()
+		if not servers:
+			return {'deleted': 0, 'failed': []}
 
-		waiting_time = 0
-		while waiting_time < self._TIMEOUT:
-			time.sleep(self._POLL_TIME)
-			waiting_time += 1
+		def delete(server):
 			try:
-				self.nova.servers.get(server.id)
+				with timed_phase('teardown', 'submit'):
+					server.delete()
 			except NotFound:
-				# this means that the server is not found,
-				# so it has been really deleted!
-				break
-
-		if waiting_time == self._TIMEOUT:
-			raise Exception('timeout exceeded on delete')
+				# already gone
+				pass
+			except Exception as e:
+				return str(e)
+			return None
 
-		return {'id': server.id}
+		concurrency = min(int(concurrency or CONF.teardown_concurrency), len(servers))
+		LOG.info('Deleting ' + str(len(servers)) + ' servers, ' + str(concurrency) + ' at a time')
+		pool = ThreadPool(concurrency)
+		try:
+			errors = pool.map(delete, servers)
+		finally:
+			pool.close()
+
+		failed = []
+		submitted = []
+		for server, error in zip(servers, errors):
+			if error is None:
+				submitted.append(server)
+			else:
+				self.inventory.release(server)
+				failed.append({'id': server.id, 'msg': error})
+
+		with timed_phase('teardown', 'wait'):
+			statuses = self.poller.wait_all(
+				[s.id for s in submitted],
+				StatusPoller.DELETED_STATUS,
+				CONF.teardown_timeout,
+				failure_statuses=()
+			)
+
+		for server in submitted:
+			if statuses[server.id] == StatusPoller.DELETED_STATUS:
+				self.inventory.remove(server.id)
+			else:
+				self.inventory.release(server)
+				failed.append({'id': server.id, 'msg': 'timeout exceeded on delete'})
+
+		return {'deleted': len(servers) - len(failed), 'failed': failed}
 
 	@reraise_as_400
 	@return_code(200)
@@ -432,7 +1531,8 @@ class NovaAPI(CRDAPI):
 		ans = {
 			'cmps': {}
 		}
-		hosts = self.nova.hypervisors.list()
+		hosts = self.hypervisors.get()
+		ans['saturated'] = self.capacity.saturated(hosts)
 		# only active hosts
 		hosts = filter(lambda h: h.vcpus_used != 0, hosts)
 
@@ -447,8 +1547,7 @@ class NovaAPI(CRDAPI):
 		for h in hosts:
 			# cmps are always in the same order in the list.
 			# we can use their index as a unique ID.
-			host_index = self._known_cmps.index(h.host_ip)
-			ans['cmps'][host_index] = {
+			ans['cmps'][self._cmp_index(h.host_ip)] = {
 				'hostname': h.hypervisor_hostname,
 				'address': h.host_ip,
 				'vcpus_used': h.vcpus_used,
@@ -0,0 +1,257 @@
+'''
+	Columnar archives of simulations.
+
+	An archive is a directory with a `meta.json` and, for each proxy
+	(`proxy<id>/`), a binary file for each column (`<column>.bin`):
+	fixed-width values in native byte order, a row for each step
+	of the simulation (steps that were not stored have `command` MISSING
+	and zeros elsewhere).
+	Host columns (HOST_COLUMNS) have a value for each host of the proxy
+	in every row, by cmp index (0 if the host is not active), step columns
+	(STEP_COLUMNS) a single one.
+
+	`Archive` memory-maps the files: with numpy, columns are `numpy.memmap`
+	arrays of shape (steps, hosts) or (steps, ), otherwise they are `Column`s.
+'''
+import array, json, mmap, os, struct, sys
+from oscard.sim import collector, common, trace
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+VERSION = 1
+MISSING = 255
+
+HOST_COLUMNS = (
+	('vcpus_used', 'i'),
+	('memory_mb_used', 'i'),
+	('local_gb_used', 'i'),
+	('r_vcpus', 'f'),
+	('r_memory_mb', 'f'),
+	('r_local_gb', 'f'),
+)
+
+STEP_COLUMNS = (
+	('command', 'B'), # index in common.COMMANDS
+	('failure', 'B'), # index in trace.OUTCOMES
+	('avg_r_vcpus', 'd'),
+	('avg_r_memory_mb', 'd'),
+	('avg_r_local_gb', 'd'),
+	('no_active_cmps', 'd'),
+	('aggr_r_vcpus', 'd'),
+	('aggr_r_memory_mb', 'd'),
+	('aggr_r_local_gb', 'd'),
+	('aggr_no_active_cmps', 'd'),
+)
+
+_CMD_CODES = dict((c, i) for i, c in enumerate(common.COMMANDS))
+_KINDS = {'B': 'u', 'i': 'i', 'f': 'f', 'd': 'f'}
+
+def _dtype(typecode):
+	'''
+		The numpy dtype of an array typecode, e.g. '<f4' for 'f'.
+	'''
+	order = '<' if sys.byteorder == 'little' else '>'
+	return order + _KINDS[typecode] + str(array.array(typecode).itemsize)
+
+def _indices(tree):
+	'''
+		Firebase returns children with integer keys as a list (with holes).
+	'''
+	if not tree:
+		return []
+	if isinstance(tree, list):
+		return [i for i, v in enumerate(tree) if v is not None]
+	return [int(k) for k in tree]
+
+def export(bifrost, path, sim_id=None):
+	'''
+		Writes the archive of a simulation (the current one if `sim_id`
+		is None) in the directory `path`, reading the snapshots of
+		one proxy at a time. Returns the meta data of the archive.
+	'''
+	reader = collector.SnapshotReader(bifrost, sim_id)
+	sim_url = '/sims/' + str(reader.sim_id)
+	steps = bifrost.app.get(sim_url, 'steps')
+	if steps is None:
+		raise Exception('No simulation ' + str(reader.sim_id))
+
+	columns = {}
+	for name, typecode in HOST_COLUMNS + STEP_COLUMNS:
+		columns[name] = {
+			'typecode': typecode,
+			'dtype': _dtype(typecode),
+			'per_host': (name, typecode) in HOST_COLUMNS
+		}
+
+	meta = {
+		'version': VERSION,
+		'sim_id': reader.sim_id,
+		'steps': steps,
+		'start': bifrost.app.get(sim_url, 'start'),
+		'end': bifrost.app.get(sim_url, 'end'),
+		'commands': common.COMMANDS,
+		'outcomes': trace.OUTCOMES,
+		'columns': columns,
+		'proxies': []
+	}
+
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+	# proxies are numbered from 0
+	proxy_id = 0
+	while True:
+		address = bifrost.app.get(sim_url + '/proxies/' + str(proxy_id), 'address')
+		if address is None:
+			break
+		meta['proxies'].append(_export_proxy(reader, proxy_id, address, steps, path))
+		proxy_id += 1
+
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump(meta, f, indent=2, sort_keys=True)
+	return meta
+
+def _export_proxy(reader, proxy_id, address, steps, path):
+	proxy_url = reader.proxy_url(proxy_id)
+	architecture = reader.bifrost.app.get(proxy_url, 'architecture')
+	stored = reader.stored(proxy_id)
+
+	# hosts seen in the architecture or in any snapshot
+	hosts = max(_indices(architecture) or [-1]) + 1
+	for t, snapshot in collector.delta_decode(stored):
+		if snapshot['cmps']:
+			hosts = max(hosts, max(int(h) for h in snapshot['cmps']) + 1)
+
+	proxy_path = os.path.join(path, 'proxy' + str(proxy_id))
+	if not os.path.isdir(proxy_path):
+		os.makedirs(proxy_path)
+
+	host_files = dict(
+		(name, open(os.path.join(proxy_path, name + '.bin'), 'wb'))
+		for name, typecode in HOST_COLUMNS
+	)
+	zeros = dict((name, array.array(typecode, [0]) * hosts) for name, typecode in HOST_COLUMNS)
+	step_columns = dict((name, array.array(typecode)) for name, typecode in STEP_COLUMNS)
+
+	def write(snapshot):
+		for name, typecode in HOST_COLUMNS:
+			row = zeros[name]
+			if snapshot is not None and snapshot['cmps']:
+				row = array.array(typecode, row)
+				for h, c in snapshot['cmps'].items():
+					row[int(h)] = c[name]
+			row.tofile(host_files[name])
+
+		for name, typecode in STEP_COLUMNS:
+			if snapshot is None:
+				value = MISSING if name == 'command' else 0
+			elif name == 'command':
+				value = _CMD_CODES.get(snapshot.get('command'), MISSING)
+			elif name == 'failure':
+				value = trace.outcome_of(snapshot.get('failure'))
+			else:
+				value = snapshot.get(name, 0)
+			step_columns[name].append(value)
+
+	try:
+		t = 0
+		for step, snapshot in collector.delta_decode(stored):
+			if step >= steps:
+				break
+			while t < step:
+				write(None)
+				t += 1
+			write(snapshot)
+			t += 1
+
+		while t < steps:
+			write(None)
+			t += 1
+	finally:
+		for f in host_files.values():
+			f.close()
+
+	for name, values in step_columns.items():
+		with open(os.path.join(proxy_path, name + '.bin'), 'wb') as f:
+			values.tofile(f)
+
+	return {
+		'id': proxy_id,
+		'address': address,
+		'hosts': hosts,
+		'steps_stored': len(stored),
+		'architecture': architecture
+	}
+
+class Column(object):
+	'''
+		A memory-mapped column, used when numpy is not available.
+		`column[t]` reads the row of step `t`: a tuple of values
+		(one for each host) for host columns, a value for step columns.
+	'''
+
+	def __init__(self, path, typecode, shape):
+		self.shape = shape
+		width = shape[1] if len(shape) > 1 else 1
+		order = '<' if sys.byteorder == 'little' else '>'
+		self._row = struct.Struct(order + str(width) + typecode)
+		self._mmap = None
+		if shape[0] and self._row.size:
+			with open(path, 'rb') as f:
+				self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self, t):
+		if t < 0:
+			t += len(self)
+		if not 0 <= t < len(self):
+			raise IndexError('step ' + str(t) + ' out of range')
+
+		row = self._row.unpack_from(self._mmap, t * self._row.size)
+		return row if len(self.shape) > 1 else row[0]
+
+	def __iter__(self):
+		for t in xrange(len(self)):
+			yield self[t]
+
+class Archive(object):
+	'''
+		Reads an archive written by `export`.
+		Nothing but `meta.json` is read until columns are accessed.
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, 'meta.json')) as f:
+			self.meta = json.load(f)
+
+		if self.meta['version'] != VERSION:
+			raise Exception(path + ': unknown archive version ' + str(self.meta['version']))
+
+		self.steps = self.meta['steps']
+		self.proxies = [p['id'] for p in self.meta['proxies']]
+
+	def hosts(self, proxy=0):
+		return self.meta['proxies'][proxy]['hosts']
+
+	def column(self, name, proxy=0):
+		'''
+			The memory-mapped column `name` of the proxy.
+		'''
+		if name not in self.meta['columns']:
+			raise Exception('Unknown column ' + name)
+
+		info = self.meta['columns'][name]
+		shape = (self.steps, self.hosts(proxy)) if info['per_host'] else (self.steps, )
+		path = os.path.join(self.path, 'proxy' + str(proxy), name + '.bin')
+
+		if numpy is not None:
+			if not self.steps or not shape[-1]:
+				return numpy.zeros(shape, dtype=info['dtype'])
+			return numpy.memmap(path, dtype=info['dtype'], mode='r', shape=shape)
+		return Column(path, info['typecode'], shape)
@@ -2,15 +2,66 @@ from firebase import firebase
 from celery.contrib.methods import task
 from celery import Celery
 from oslo.config import cfg
-import datetime
+import datetime, threading, time, Queue
 from oscard import config, log
+from oscard.sim import localstore
 
 bifrost_opts = [
 	cfg.StrOpt(
 		name='fb_backend',
 		default='https://fake.url.firebaseio.com',
 		help='Your app url on Firebase'
-	)
+	),
+	cfg.StrOpt(
+		name='fb_fallback',
+		default='sqlite',
+		choices=['sqlite', 'fake'],
+		help='Where results go if Firebase is unreachable: '
+			'a local SQLite database or nowhere (fake)'
+	),
+	cfg.StrOpt(
+		name='fb_sqlite_file',
+		default='logs/oscard.db',
+		help='SQLite database used when fb_fallback is sqlite'
+	),
+	cfg.IntOpt(
+		name='fb_batch_size',
+		default=100,
+		help='Pending writes that trigger a flush to Firebase (1 disables batching)'
+	),
+	cfg.FloatOpt(
+		name='fb_flush_interval',
+		default=5.0,
+		help='Seconds after which pending writes are flushed anyway'
+	),
+	cfg.IntOpt(
+		name='fb_keyframe_interval',
+		default=50,
+		help='Steps between full snapshots, the ones in between only store the hosts '
+			'that changed (1 stores every snapshot in full)'
+	),
+	cfg.StrOpt(
+		name='fb_writer',
+		default='auto',
+		choices=['auto', 'celery', 'background', 'sync'],
+		help='How results are written: through Celery, on background threads '
+			'or synchronously (auto uses Celery if a worker is up)'
+	),
+	cfg.FloatOpt(
+		name='celery_probe_timeout',
+		default=0.5,
+		help='Seconds to wait for the broker and Celery workers when checking if they are up'
+	),
+	cfg.IntOpt(
+		name='fb_writer_threads',
+		default=1,
+		help='Background writer threads (more than 1 does not preserve write order)'
+	),
+	cfg.IntOpt(
+		name='fb_writer_queue_size',
+		default=1000,
+		help='Writes queued before the simulation blocks waiting for the background writer'
+	),
 ]
 
 CONF = cfg.CONF
@@ -19,6 +70,22 @@ LOG = log.get_logger(__name__)
 
 cel = Celery('bifrost_tasks', backend='amqp', broker='amqp://guest@localhost//')
 
+def celery_workers_up(timeout=None):
+	'''
+		True if a Celery worker answers within `timeout` seconds
+		(`celery_probe_timeout` if None). Raises if the broker is down,
+		without retrying the connection.
+	'''
+	if timeout is None:
+		timeout = CONF.celery_probe_timeout
+
+	conn = cel.connection(connect_timeout=timeout)
+	try:
+		conn.connect()
+		return bool(cel.control.inspect(timeout=timeout, connection=conn).stats())
+	finally:
+		conn.release()
+
 class FakeFirebaseApplication(object):
 	'''
 		Class that mimics Firebase in a fake context.
@@ -27,6 +94,9 @@ class FakeFirebaseApplication(object):
 	id = 0
 
 	def put(self, *args, **kwargs):
+		if args[:2] == ('/', 'last_sim_id'):
+			# keep track of the sim id, as Firebase would
+			self.id = args[2]
 		return {}
 
 	def patch(self, *args, **kwargs):
@@ -43,10 +113,13 @@ class FakeFirebaseApplication(object):
 			return str(datetime.datetime.now())
 
 _bifrost = None
+_bifrost_lock = threading.Lock()
 def get_fb_backend():
 	global _bifrost
 	if _bifrost is None:
-		_bifrost = BifrostAPI()
+		with _bifrost_lock:
+			if _bifrost is None:
+				_bifrost = BifrostAPI()
 	return _bifrost
 
 class BifrostAPI(object):
@@ -60,6 +133,10 @@ class BifrostAPI(object):
 		return self.app.get('/last_sim_id', None)
 
 	def __init__(self):
+		# id of the simulation added by this process.
+		# used when sim_id is omitted, saves a GET on /last_sim_id.
+		self.sim_id = None
+
 		# we have to init from configuration file
 		# in case the module is run from celery worker!
 		# we do it inside __init__ because of conflicts
@@ -72,8 +149,12 @@ class BifrostAPI(object):
 			# doing a get request to test connection
 			self.seed
 		except Exception as e:
-			self.app = FakeFirebaseApplication()
-			LOG.warning('No Firebase backend created! Results will NOT be stored.')
+			if CONF.fb_fallback == 'sqlite':
+				self.app = localstore.SQLiteApplication(CONF.fb_sqlite_file)
+				LOG.warning('No Firebase backend created! Results will be stored in ' + CONF.fb_sqlite_file)
+			else:
+				self.app = FakeFirebaseApplication()
+				LOG.warning('No Firebase backend created! Results will NOT be stored.')
 
 		if self.seed is None:
 			self.app.put('/', 'last_sim_id', -1)
@@ -83,13 +164,19 @@ class BifrostAPI(object):
 		self.app.put('/', 'last_sim_id', last_id)
 		return last_id
 
+	def _current_sim_id(self, sim_id=None):
+		if sim_id is not None:
+			return sim_id
+		if self.sim_id is not None:
+			return self.sim_id
+		return self.seed
+
 	def is_sim_running(self):
 		return self.app.get('/running', None)
 
 	@task(name='bifrost.update_architecture')
 	def update_architecture(self, host_id, arch, sim_id=None):
-		if not sim_id:
-			sim_id = self.seed
+		sim_id = self._current_sim_id(sim_id)
 
 		base_url = '/sims/' + str(sim_id) + '/proxies/' + str(host_id)
 
@@ -97,8 +184,7 @@ class BifrostAPI(object):
 
 	@task(name='bifrost.update_no_failures')
 	def update_no_failures(self, host_id, nf, sim_id=None):
-		if not sim_id:
-			sim_id = self.seed
+		sim_id = self._current_sim_id(sim_id)
 
 		base_url = '/sims/' + str(sim_id) + '/proxies/' + str(host_id)
 
@@ -106,8 +192,7 @@ class BifrostAPI(object):
 
 	@task(name='bifrost.add_snapshot')
 	def add_snapshot(self, host_id, step, command_name, snapshot, sim_id=None):
-		if not sim_id:
-			sim_id = self.seed
+		sim_id = self._current_sim_id(sim_id)
 
 		snapshot['command'] = command_name
 		base_url = '/sims/' + str(sim_id) + '/proxies/' + str(host_id)
@@ -116,11 +201,20 @@ class BifrostAPI(object):
 
 	@task(name='bifrost.update_no_instr')
 	def update_no_instr(self, no_instr, sim_id=None):
-		if not sim_id:
-			sim_id = self.seed
+		sim_id = self._current_sim_id(sim_id)
 
 		return self.app.patch('/sims/' + str(sim_id), no_instr)
 
+	@task(name='bifrost.write_many')
+	def write_many(self, updates):
+		'''
+			- updates: a dict with paths (relative to the root) as keys
+				and the values to be set as values.
+
+			All of them are written with a single multi-path PATCH.
+		'''
+		return self.app.patch('/', updates)
+
 	def add_sim(self, steps, hosts_dict, id=None, created_at=None):
 		'''
 			- steps: the number of steps
@@ -180,12 +274,13 @@ class BifrostAPI(object):
 			'start': created_at,
 		}
 
+		self.sim_id = id
 		self.app.patch('/', {'running': True})
 		return id, self.app.put('/sims', str(id), data)
 
 	def add_end_to_current_sim(self, steps_run):
 		default_formatting = '%Y-%m-%d %H:%M:%S.%f'
-		id = self.seed
+		id = self._current_sim_id()
 
 		start = self.app.get('/sims/' + str(id), 'start')
 		start = datetime.datetime.strptime(start, default_formatting)
@@ -209,4 +304,243 @@ class BifrostAPI(object):
 			url = '/sims/' + str(id) + '/proxies/' + str(p_id)
 			self.app.patch(url, {'steps_run': steps_run[p_id]})
 
-		return self.app.patch('/sims/' + str(id), data)
\ No newline at end of file
+		return self.app.patch('/sims/' + str(id), data)
+
+class BatchWriter(object):
+	'''
+		Buffers the per-step writes of a simulation and sends them
+		to Bifrost as multi-path PATCHes (see `BifrostAPI.write_many`).
+
+		Pending writes are indexed by path, so writing twice the same key
+		(e.g. `architecture` or `no_instr`) only keeps the last value.
+		Writes are flushed when `max_pending` paths are pending or when
+		`flush_interval` seconds passed since the last flush (checked on write),
+		and always at the end of the simulation.
+
+		Snapshots are delta-encoded: every `keyframe_interval` steps
+		a snapshot is stored in full, the ones in between only store
+		the hosts that changed since the previous snapshot (see `delta_encode`).
+		Snapshots of a proxy must be added in step order.
+
+		- dispatch: the function used to run `write_many`,
+			called as `dispatch(method, *args)` (e.g. through Celery).
+	'''
+
+	def __init__(self, bifrost, dispatch=None, max_pending=None, flush_interval=None,
+			keyframe_interval=None):
+		self.bifrost = bifrost
+		self._dispatch = dispatch or (lambda method, *args: method(*args))
+		self.max_pending = max_pending or CONF.fb_batch_size
+		self.flush_interval = flush_interval or CONF.fb_flush_interval
+		self.keyframe_interval = keyframe_interval or CONF.fb_keyframe_interval
+		self._pending = {}
+		self._lock = threading.Lock()
+		self._last_flush = time.time()
+		# by proxy path: (keyframe step, cmps of the last snapshot)
+		self._last_cmps = {}
+
+	def _proxy_path(self, sim_id, host_id):
+		sim_id = self.bifrost._current_sim_id(sim_id)
+		return 'sims/' + str(sim_id) + '/proxies/' + str(host_id)
+
+	def _set(self, updates):
+		with self._lock:
+			self._pending.update(updates)
+			due = len(self._pending) >= self.max_pending \
+				or time.time() - self._last_flush >= self.flush_interval
+
+		if due:
+			self.flush()
+
+	def update_architecture(self, host_id, arch, sim_id=None):
+		self._set({self._proxy_path(sim_id, host_id) + '/architecture': arch})
+
+	def update_no_failures(self, host_id, nf, sim_id=None):
+		self._set({self._proxy_path(sim_id, host_id) + '/no_failures': nf})
+
+	def add_snapshot(self, host_id, step, command_name, snapshot, sim_id=None):
+		snapshot['command'] = command_name
+		path = self._proxy_path(sim_id, host_id)
+
+		with self._lock:
+			keyframe, prev = self._last_cmps.get(path, (None, None))
+			if keyframe is None or step - keyframe >= self.keyframe_interval:
+				keyframe = step
+			self._last_cmps[path] = (keyframe, _as_dict(snapshot.get('cmps')))
+
+		self._set({path + '/snapshots/' + str(step): delta_encode(snapshot, step, keyframe, prev)})
+
+	def update_no_instr(self, no_instr, sim_id=None):
+		base_url = 'sims/' + str(self.bifrost._current_sim_id(sim_id))
+		self._set(dict((base_url + '/' + k, v) for k, v in no_instr.items()))
+
+	def flush(self):
+		with self._lock:
+			updates, self._pending = self._pending, {}
+			self._last_flush = time.time()
+
+		if updates:
+			self._dispatch(self.bifrost.write_many, updates)
+
+	def add_end_to_current_sim(self, steps_run):
+		self.flush()
+		return self.bifrost.add_end_to_current_sim(steps_run)
+
+
+def _as_dict(cmps):
+	'''
+		Hosts by (string) index. Firebase returns children
+		with integer keys as a list (with holes).
+	'''
+	if not cmps:
+		return {}
+	if isinstance(cmps, list):
+		return dict((str(h), c) for h, c in enumerate(cmps) if c is not None)
+	return dict((str(h), c) for h, c in cmps.items())
+
+def delta_encode(snapshot, step, keyframe, prev_cmps=None):
+	'''
+		Returns the snapshot to store at `step`.
+		Every stored snapshot has the step of its `keyframe`.
+		If it is `step`, `cmps` is stored in full.
+		Otherwise hosts changed since `prev_cmps` (the ones of the previous
+		stored snapshot) are in `cmps_changed` and the ones no more
+		active are listed in `cmps_removed`.
+		Other fields (averages, aggregates, ...) are always stored.
+	'''
+	stored = dict(snapshot)
+	stored['keyframe'] = keyframe
+	if keyframe == step:
+		return stored
+
+	cmps = _as_dict(stored.pop('cmps', None))
+	prev_cmps = _as_dict(prev_cmps)
+	changed = dict((h, c) for h, c in cmps.items() if prev_cmps.get(h) != c)
+	removed = [h for h in prev_cmps if h not in cmps]
+	if changed:
+		stored['cmps_changed'] = changed
+	if removed:
+		stored['cmps_removed'] = removed
+	return stored
+
+def delta_decode(stored_snapshots):
+	'''
+		Rebuilds full snapshots from the ones stored by `BatchWriter`,
+		given as (step, stored snapshot) in step order, starting with
+		a keyframe. Yields (step, snapshot).
+		Snapshots stored in full (e.g. before delta encoding) are fine too.
+	'''
+	cmps = None
+	for step, stored in stored_snapshots:
+		snapshot = dict(stored)
+		keyframe = snapshot.pop('keyframe', step)
+		changed = _as_dict(snapshot.pop('cmps_changed', None))
+		removed = snapshot.pop('cmps_removed', None) or []
+
+		if keyframe == step:
+			cmps = _as_dict(snapshot.get('cmps'))
+		elif cmps is None:
+			raise Exception('Snapshot ' + str(step) + ' comes before its keyframe (' + str(keyframe) + ')')
+		else:
+			cmps = dict(cmps)
+			cmps.update(changed)
+			for h in removed:
+				cmps.pop(h, None)
+
+		snapshot['cmps'] = cmps
+		yield step, snapshot
+
+def _by_step(snapshots):
+	return sorted((int(t), s) for t, s in _as_dict(snapshots).items())
+
+class SnapshotReader(object):
+	'''
+		Reads the full snapshots of a simulation, rebuilding
+		the delta-encoded ones (see `BatchWriter`).
+	'''
+
+	def __init__(self, bifrost, sim_id=None):
+		self.bifrost = bifrost
+		self.sim_id = bifrost._current_sim_id(sim_id)
+
+	def proxy_url(self, host_id):
+		return '/sims/' + str(self.sim_id) + '/proxies/' + str(host_id)
+
+	def _snapshots_url(self, host_id):
+		return self.proxy_url(host_id) + '/snapshots'
+
+	def stored(self, host_id):
+		'''
+			(step, stored snapshot) of every step of the proxy, as stored.
+		'''
+		return _by_step(self.bifrost.app.get(self.proxy_url(host_id), 'snapshots'))
+
+	def snapshots(self, host_id):
+		'''
+			Yields (step, snapshot) of every step of the proxy,
+			with a single read.
+		'''
+		return delta_decode(self.stored(host_id))
+
+	def snapshot(self, host_id, step):
+		'''
+			The snapshot of the proxy at `step` (None if it wasn't stored).
+			It reads the snapshots from its keyframe on.
+		'''
+		url = self._snapshots_url(host_id)
+		stored = self.bifrost.app.get(url, str(step))
+		if stored is None:
+			return None
+
+		keyframe = stored.get('keyframe', step)
+		steps = [(t, self.bifrost.app.get(url, str(t))) for t in xrange(keyframe, step)]
+		steps = [(t, s) for t, s in steps if s is not None] + [(step, stored)]
+
+		return list(delta_decode(steps))[-1][1]
+
+class BackgroundWriter(object):
+	'''
+		Runs Bifrost methods on background threads, in-process,
+		so that storing results doesn't block the simulation.
+
+		`submit` has the same signature of the `run_on_bifrost` function
+		in `oscard.sim.run`: `submit(method, *args)`.
+		If the queue is full, `submit` blocks until a slot is freed.
+		`close` waits for every queued write and stops the threads.
+	'''
+
+	def __init__(self, threads=None, queue_size=None):
+		self._queue = Queue.Queue(maxsize=queue_size or CONF.fb_writer_queue_size)
+		self._threads = []
+
+		for i in xrange(threads or CONF.fb_writer_threads):
+			th = threading.Thread(target=self._work, name='bifrost-writer-' + str(i))
+			th.daemon = True
+			th.start()
+			self._threads.append(th)
+
+	def _work(self):
+		while True:
+			item = self._queue.get()
+			try:
+				if item is None:
+					return
+
+				method, args = item
+				try:
+					method(*args)
+				except Exception as e:
+					LOG.error('Background write failed: ' + str(e))
+			finally:
+				self._queue.task_done()
+
+	def submit(self, method, *args):
+		self._queue.put((method, args))
+
+	def close(self):
+		self._queue.join()
+		for th in self._threads:
+			self._queue.put(None)
+		for th in self._threads:
+			th.join()
+		self._threads = []
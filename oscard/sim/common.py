@@ -0,0 +1,43 @@
+'''
+	What the simulation tools (the sim client, the proxy, sweeps,
+	traces and workloads) share: the commands, the rules they are
+	drawn with and the tables results are printed in.
+'''
+
+COMMANDS = ('create', 'resize', 'destroy', 'nop')
+DELTAS = {'create': 1, 'destroy': -1} # how commands change the number of instances
+
+def weighted(weights):
+	'''
+		The commands, each one repeated as many times as its weight
+		(`weights` are the ones of create, resize, delete and nop):
+		steps draw their command from this list.
+	'''
+	cmds = [c for c, w in zip(COMMANDS, weights) for i in xrange(w)]
+	if not cmds:
+		raise Exception('Weights ' + str(weights) + ' are all 0')
+	return cmds
+
+def command_to_run(cmd, count):
+	'''
+		The command a step runs when it draws `cmd` and there are `count`
+		instances: if there are none, a create (whatever was drawn).
+	'''
+	if count <= 0:
+		return 'create'
+	return cmd
+
+def format_table(columns, rows):
+	'''
+		A text table of `rows` (dicts), with a column for each of `columns`.
+	'''
+	def fmt(v):
+		if v is None:
+			return '-'
+		if isinstance(v, float):
+			return '%.4f' % v
+		return str(v)
+
+	lines = [columns] + [[fmt(r[c]) for c in columns] for r in rows]
+	widths = [max(len(l[i]) for l in lines) for i in xrange(len(columns))]
+	return '\n'.join('  '.join(v.rjust(w) for v, w in zip(l, widths)) for l in lines)
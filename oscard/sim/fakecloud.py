@@ -0,0 +1,341 @@
+import heapq, threading
+
+# the 5 default Nova flavors
+FLAVORS = {
+	1: {'name': 'm1.tiny', 'vcpus': 1, 'ram': 512, 'disk': 1},
+	2: {'name': 'm1.small', 'vcpus': 1, 'ram': 2048, 'disk': 20},
+	3: {'name': 'm1.medium', 'vcpus': 2, 'ram': 4096, 'disk': 40},
+	4: {'name': 'm1.large', 'vcpus': 4, 'ram': 8192, 'disk': 80},
+	5: {'name': 'm1.xlarge', 'vcpus': 8, 'ram': 16384, 'disk': 160},
+}
+
+NO_VALID_HOST = 'No valid host was found. There are not enough hosts available.'
+
+class NoValidHost(Exception):
+	pass
+
+class Host(object):
+	def __init__(self, index, vcpus, memory_mb, local_gb):
+		self.index = index
+		self.hostname = 'fakehost' + str(index)
+		self.address = '42.42.' + str(index / 256) + '.' + str(index % 256)
+		self.vcpus = vcpus
+		self.memory_mb = memory_mb
+		self.local_gb = local_gb
+		self.vcpus_used = 0
+		self.memory_mb_used = 0
+		self.local_gb_used = 0
+
+	def claim(self, flavor, sign=1):
+		self.vcpus_used += sign * flavor['vcpus']
+		self.memory_mb_used += sign * flavor['ram']
+		self.local_gb_used += sign * flavor['disk']
+
+class Server(object):
+	def __init__(self, id, flavor_id, host, status):
+		self.id = id
+		self.flavor_id = flavor_id
+		self.host = host
+		self.status = status
+
+class VirtualCluster(object):
+	'''
+		A discrete-event model of a Nova cluster.
+		Compute hosts have vcpus, memory and disk, and servers are placed
+		like the filter scheduler does (Core, Ram and Disk filters with
+		allocation ratios, then the host with most free RAM wins).
+
+		Time is virtual: every operation schedules its completion
+		`durations[op]` seconds after the current `clock`,
+		and the call returns once the clock reaches it.
+		No real time passes.
+
+		For each flavor, the hosts it fits on are kept in a set and in a heap
+		by free RAM (entries are invalidated lazily when a host changes).
+		Placing a server takes logarithmic time even with thousands of hosts,
+		whatever resource is the binding one, and finding out that a flavor
+		fits nowhere (or that nothing fits anywhere) takes constant time.
+		Snapshots only visit active hosts.
+	'''
+
+	def __init__(self, hosts, flavors=FLAVORS, durations=None,
+			cpu_ratio=16.0, ram_ratio=1.5, disk_ratio=1.0):
+		'''
+			- hosts: a list of (vcpus, memory_mb, local_gb)
+			- durations: a dict with virtual seconds for 'create', 'resize' and 'delete'
+		'''
+		self.hosts = [Host(i, *h) for i, h in enumerate(hosts)]
+		self.flavors = flavors
+		self.durations = {'create': 0.0, 'resize': 0.0, 'delete': 0.0}
+		self.durations.update(durations or {})
+		self.cpu_ratio = cpu_ratio
+		self.ram_ratio = ram_ratio
+		self.disk_ratio = disk_ratio
+
+		self.clock = 0.0
+		self.servers = {}
+		self._events = []
+		self._seq = 0
+		self._lock = threading.RLock()
+
+		# for each flavor, the hosts it fits on, and a heap of
+		# (-free_ram, host index, version) of them
+		self._feasible = dict((f, set()) for f in self.flavors)
+		self._heaps = dict((f, []) for f in self.flavors)
+		self._versions = [0] * len(self.hosts)
+		for h in self.hosts:
+			self._index(h)
+
+		# snapshot entries of active hosts, and the sums of their ratios
+		self._active = {}
+		self._r_sums = {'r_vcpus': 0.0, 'r_memory_mb': 0.0, 'r_local_gb': 0.0}
+
+		self._arch = {}
+		for h in self.hosts:
+			self._arch[h.index] = {
+				'hostname': h.hostname,
+				'address': h.address,
+				'vcpus': h.vcpus,
+				'memory_mb': h.memory_mb,
+				'local_gb': h.local_gb,
+			}
+
+	# discrete events
+
+	def _schedule(self, delay, callback):
+		self._seq += 1
+		heapq.heappush(self._events, (self.clock + delay, self._seq, callback))
+		return self._seq
+
+	def _run_until(self, seq):
+		'''
+			Processes events in time order, up to the one with id `seq`.
+		'''
+		while self._events:
+			when, s, callback = heapq.heappop(self._events)
+			self.clock = when
+			callback()
+			if s == seq:
+				return
+
+	# scheduler
+
+	def _fits(self, host, flavor, freed=None):
+		vcpus, ram, disk = host.vcpus_used, host.memory_mb_used, host.local_gb_used
+		if freed is not None:
+			vcpus -= freed['vcpus']
+			ram -= freed['ram']
+			disk -= freed['disk']
+
+		return vcpus + flavor['vcpus'] <= host.vcpus * self.cpu_ratio \
+			and ram + flavor['ram'] <= host.memory_mb * self.ram_ratio \
+			and disk + flavor['disk'] <= host.local_gb * self.disk_ratio
+
+	def _free_ram(self, host):
+		return host.memory_mb * self.ram_ratio - host.memory_mb_used
+
+	def _index(self, host):
+		'''
+			Updates the flavors that fit on `host`, after it changed.
+			Older entries of the host in the heaps become stale.
+		'''
+		self._versions[host.index] += 1
+		entry = (-self._free_ram(host), host.index, self._versions[host.index])
+
+		for f, flavor in self.flavors.items():
+			if not self._fits(host, flavor):
+				self._feasible[f].discard(host.index)
+				continue
+
+			self._feasible[f].add(host.index)
+			heap = self._heaps[f]
+			heapq.heappush(heap, entry)
+
+			if len(heap) > 4 * len(self.hosts) + 64:
+				# too many stale entries
+				heap = [(-self._free_ram(self.hosts[i]), i, self._versions[i]) for i in self._feasible[f]]
+				heapq.heapify(heap)
+				self._heaps[f] = heap
+
+	def _top(self, flavor_id, skip=None):
+		'''
+			The host with most free RAM among the ones the flavor
+			fits on, but `skip` (a host index), or None.
+		'''
+		heap = self._heaps[flavor_id]
+		skipped = None
+		top = None
+		while heap:
+			neg_free, index, version = heap[0]
+			if version != self._versions[index]:
+				heapq.heappop(heap)
+				continue
+
+			if index == skip:
+				skipped = heapq.heappop(heap)
+				continue
+
+			top = self.hosts[index]
+			break
+
+		if skipped is not None:
+			heapq.heappush(heap, skipped)
+		return top
+
+	def _claim(self, host, flavor, sign=1):
+		entry = self._active.pop(host.index, None)
+		if entry is not None:
+			for key in self._r_sums:
+				self._r_sums[key] -= entry[key]
+
+		host.claim(flavor, sign)
+
+		if host.vcpus_used != 0:
+			# a new dict, the old one could be in a snapshot
+			entry = {
+				'hostname': host.hostname,
+				'address': host.address,
+				'vcpus_used': host.vcpus_used,
+				'memory_mb_used': host.memory_mb_used,
+				'local_gb_used': host.local_gb_used,
+				'r_vcpus': float(host.vcpus_used) / host.vcpus,
+				'r_memory_mb': float(host.memory_mb_used) / host.memory_mb,
+				'r_local_gb': float(host.local_gb_used) / host.local_gb
+			}
+			self._active[host.index] = entry
+			for key in self._r_sums:
+				self._r_sums[key] += entry[key]
+
+		if not self._active:
+			# no drift when the cluster is empty
+			for key in self._r_sums:
+				self._r_sums[key] = 0.0
+
+		self._index(host)
+
+	def _select_host(self, flavor_id, current=None, freed=None):
+		'''
+			The host with most free RAM among the ones with room for the
+			flavor. If `current` is given, `freed` resources are available on it.
+		'''
+		best = None
+		if current is not None and self._fits(current, self.flavors[flavor_id], freed):
+			best = current
+
+		if self._feasible[flavor_id]:
+			host = self._top(flavor_id, skip=current.index if current is not None else None)
+			if host is not None:
+				if best is None or self._free_ram(host) > self._free_ram(best) \
+						or (self._free_ram(host) == self._free_ram(best) and host.index < best.index):
+					best = host
+
+		if best is None:
+			raise NoValidHost(NO_VALID_HOST)
+		return best
+
+	def _saturated(self):
+		'''
+			True if no flavor fits on any host: every create would fail.
+		'''
+		return not any(self._feasible.values())
+
+	# operations
+
+	def create(self, server_id, flavor_id):
+		'''
+			Returns the new server. If there is no room for it,
+			the server is in ERROR status and NoValidHost is raised.
+		'''
+		with self._lock:
+			flavor = self.flavors[flavor_id]
+			server = Server(server_id, flavor_id, None, 'BUILD')
+			self.servers[server_id] = server
+
+			try:
+				host = self._select_host(flavor_id)
+			except NoValidHost:
+				server.status = 'ERROR'
+				raise
+
+			self._claim(host, flavor)
+			server.host = host
+
+			def built():
+				server.status = 'ACTIVE'
+
+			self._run_until(self._schedule(self.durations['create'], built))
+			return server
+
+	def resize(self, server_id, flavor_id):
+		'''
+			Resizes (and confirms) an ACTIVE server.
+			If there is no room for the new flavor, NoValidHost is raised
+			and the server stays as it is.
+		'''
+		with self._lock:
+			server = self.servers[server_id]
+			old = self.flavors[server.flavor_id]
+			new = self.flavors[flavor_id]
+			host = self._select_host(flavor_id, current=server.host, freed=old)
+
+			# both claims are held during the resize
+			self._claim(host, new)
+			server.status = 'RESIZE'
+
+			def resized():
+				self._claim(server.host, old, sign=-1)
+				server.host = host
+				server.flavor_id = flavor_id
+				server.status = 'ACTIVE'
+
+			self._run_until(self._schedule(self.durations['resize'], resized))
+			return server
+
+	def wait(self, seconds):
+		'''
+			Lets `seconds` of virtual time pass (e.g. for a nop).
+		'''
+		with self._lock:
+			self._run_until(self._schedule(seconds, lambda: None))
+
+	def delete(self, server_id):
+		with self._lock:
+			server = self.servers[server_id]
+			server.status = 'DELETING'
+
+			def deleted():
+				if server.host is not None:
+					self._claim(server.host, self.flavors[server.flavor_id], sign=-1)
+				del self.servers[server_id]
+
+			self._run_until(self._schedule(self.durations['delete'], deleted))
+			return server
+
+	# state
+
+	def architecture(self):
+		'''
+			Hosts don't change, don't modify the dict returned.
+		'''
+		return self._arch
+
+	def snapshot(self):
+		'''
+			Same format of `NovaAPI.snapshot`.
+		'''
+		with self._lock:
+			n_active_hosts = float(len(self._active))
+			ans = {
+				'cmps': dict(self._active),
+				'avg_r_vcpus': 0,
+				'avg_r_memory_mb': 0,
+				'avg_r_local_gb': 0,
+				'no_active_cmps': n_active_hosts,
+				'saturated': self._saturated()
+			}
+
+			if n_active_hosts > 0:
+				for key in self._r_sums:
+					ans['avg_' + key] = self._r_sums[key] / n_active_hosts
+
+			return ans
@@ -0,0 +1,277 @@
+import json, sqlite3, threading
+
+_SCHEMA = '''
+	CREATE TABLE IF NOT EXISTS meta (
+		key TEXT PRIMARY KEY,
+		value TEXT
+	);
+	CREATE TABLE IF NOT EXISTS sims (
+		sim_id INTEGER,
+		key TEXT,
+		value TEXT,
+		PRIMARY KEY (sim_id, key)
+	);
+	CREATE TABLE IF NOT EXISTS proxies (
+		sim_id INTEGER,
+		proxy INTEGER,
+		key TEXT,
+		value TEXT,
+		PRIMARY KEY (sim_id, proxy, key)
+	);
+	CREATE TABLE IF NOT EXISTS snapshots (
+		sim_id INTEGER,
+		proxy INTEGER,
+		step INTEGER,
+		command TEXT,
+		data TEXT,
+		PRIMARY KEY (sim_id, proxy, step)
+	);
+	CREATE INDEX IF NOT EXISTS snapshots_by_step ON snapshots (sim_id, step, proxy);
+'''
+
+def _split(url, name=None):
+	parts = [p for p in url.split('/') if p]
+	if name is not None:
+		parts += [p for p in str(name).split('/') if p]
+	return parts
+
+def _nested_set(obj, keys, value):
+	if not keys:
+		return value
+
+	if not isinstance(obj, dict):
+		obj = {}
+
+	child = _nested_set(obj.get(keys[0]), keys[1:], value)
+	if child is None:
+		obj.pop(keys[0], None)
+	else:
+		obj[keys[0]] = child
+	return obj
+
+def _nested_get(obj, keys):
+	for k in keys:
+		if not isinstance(obj, dict) or k not in obj:
+			return None
+		obj = obj[k]
+	return obj
+
+class SQLiteApplication(object):
+	'''
+		Stores simulation results in a local SQLite database.
+		It mimics the FirebaseApplication `put`, `patch` and `get` methods,
+		so it can be used as the `app` of BifrostAPI.
+
+		The tree is split in tables:
+			/<key>                                         --> meta
+			/sims/<sim_id>/<key>                           --> sims
+			/sims/<sim_id>/proxies/<proxy>/<key>           --> proxies
+			/sims/<sim_id>/proxies/<proxy>/snapshots/<step> --> snapshots
+
+		Every put/patch is run in a single transaction, so a multi-path PATCH
+		(see `BifrostAPI.write_many`) is a single batched commit.
+	'''
+
+	def __init__(self, db_file):
+		self.db_file = db_file
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(db_file, check_same_thread=False)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.executescript(_SCHEMA)
+
+	# Firebase-like interface
+
+	def put(self, url, name, data, *args, **kwargs):
+		with self._lock, self._conn:
+			self._set(_split(url, name), data)
+		return data
+
+	def patch(self, url, data, *args, **kwargs):
+		base = _split(url)
+		with self._lock, self._conn:
+			for k, v in data.items():
+				self._set(base + _split(k), v)
+		return data
+
+	def get(self, url, name=None, *args, **kwargs):
+		with self._lock:
+			return self._get(_split(url, name))
+
+	# queries
+
+	def snapshots(self, sim_id, proxy=None, step=None):
+		'''
+			Returns a list of (proxy, step, snapshot) of the given simulation,
+			ordered by step and proxy. Snapshots are returned as stored
+			(see `collector.delta_decode`).
+			Use `proxy` and/or `step` to filter them.
+		'''
+		query = 'SELECT proxy, step, data FROM snapshots WHERE sim_id = ?'
+		params = [int(sim_id)]
+
+		if proxy is not None:
+			query += ' AND proxy = ?'
+			params.append(int(proxy))
+
+		if step is not None:
+			query += ' AND step = ?'
+			params.append(int(step))
+
+		query += ' ORDER BY step, proxy'
+
+		with self._lock:
+			rows = self._conn.execute(query, params).fetchall()
+		return [(p, s, json.loads(d)) for p, s, d in rows]
+
+	# tree <--> tables
+
+	def _set(self, parts, value):
+		n = len(parts)
+		if n == 0:
+			self._delete_all()
+			self._set_children(parts, value)
+		elif parts[0] != 'sims':
+			self._set_record('meta', ('key',), (parts[0], ), parts[1:], value)
+		elif n == 1:
+			self._delete_sims()
+			self._set_children(parts, value)
+		elif n == 2:
+			self._delete_sims(sim_id=int(parts[1]))
+			self._set_children(parts, value)
+		elif parts[2] != 'proxies':
+			self._set_record('sims', ('sim_id', 'key'), (int(parts[1]), parts[2]), parts[3:], value)
+		elif n == 3:
+			self._delete_proxies(int(parts[1]))
+			self._set_children(parts, value)
+		elif n == 4:
+			self._delete_proxies(int(parts[1]), proxy=int(parts[3]))
+			self._set_children(parts, value)
+		elif parts[4] != 'snapshots':
+			self._set_record('proxies', ('sim_id', 'proxy', 'key'),
+				(int(parts[1]), int(parts[3]), parts[4]), parts[5:], value)
+		elif n == 5:
+			self._delete_proxies(int(parts[1]), proxy=int(parts[3]), only_snapshots=True)
+			self._set_children(parts, value)
+		else:
+			self._set_snapshot(int(parts[1]), int(parts[3]), int(parts[5]), parts[6:], value)
+
+	def _set_children(self, parts, value):
+		if isinstance(value, dict):
+			for k, v in value.items():
+				self._set(parts + [str(k)], v)
+
+	def _set_record(self, table, key_cols, key_vals, rest, value):
+		where = ' AND '.join(c + ' = ?' for c in key_cols)
+		if rest:
+			row = self._conn.execute('SELECT value FROM ' + table + ' WHERE ' + where, key_vals).fetchone()
+			value = _nested_set(json.loads(row[0]) if row else None, rest, value)
+
+		if value is None:
+			self._conn.execute('DELETE FROM ' + table + ' WHERE ' + where, key_vals)
+		else:
+			cols = ', '.join(key_cols + ('value', ))
+			marks = ', '.join('?' * (len(key_cols) + 1))
+			self._conn.execute(
+				'INSERT OR REPLACE INTO ' + table + ' (' + cols + ') VALUES (' + marks + ')',
+				key_vals + (json.dumps(value), )
+			)
+
+	def _set_snapshot(self, sim_id, proxy, step, rest, value):
+		key = (sim_id, proxy, step)
+		where = 'sim_id = ? AND proxy = ? AND step = ?'
+		if rest:
+			row = self._conn.execute('SELECT data FROM snapshots WHERE ' + where, key).fetchone()
+			value = _nested_set(json.loads(row[0]) if row else None, rest, value)
+
+		if value is None:
+			self._conn.execute('DELETE FROM snapshots WHERE ' + where, key)
+		else:
+			command = value.get('command') if isinstance(value, dict) else None
+			self._conn.execute(
+				'INSERT OR REPLACE INTO snapshots (sim_id, proxy, step, command, data) VALUES (?, ?, ?, ?, ?)',
+				key + (command, json.dumps(value))
+			)
+
+	def _delete_all(self):
+		self._conn.execute('DELETE FROM meta')
+		self._delete_sims()
+
+	def _delete_sims(self, sim_id=None):
+		if sim_id is None:
+			for table in ('sims', 'proxies', 'snapshots'):
+				self._conn.execute('DELETE FROM ' + table)
+		else:
+			self._conn.execute('DELETE FROM sims WHERE sim_id = ?', (sim_id, ))
+			self._delete_proxies(sim_id)
+
+	def _delete_proxies(self, sim_id, proxy=None, only_snapshots=False):
+		tables = ('snapshots', ) if only_snapshots else ('proxies', 'snapshots')
+		for table in tables:
+			if proxy is None:
+				self._conn.execute('DELETE FROM ' + table + ' WHERE sim_id = ?', (sim_id, ))
+			else:
+				self._conn.execute('DELETE FROM ' + table + ' WHERE sim_id = ? AND proxy = ?', (sim_id, proxy))
+
+	def _get(self, parts):
+		n = len(parts)
+		if n == 0:
+			tree = dict((k, json.loads(v)) for k, v in self._conn.execute('SELECT key, value FROM meta'))
+			sims = self._get_sims()
+			if sims:
+				tree['sims'] = sims
+			return tree or None
+
+		if parts[0] != 'sims':
+			return self._get_record('meta', ('key', ), (parts[0], ), parts[1:])
+
+		if n == 1:
+			return self._get_sims() or None
+
+		sim_id = int(parts[1])
+		if n > 2 and parts[2] != 'proxies':
+			return self._get_record('sims', ('sim_id', 'key'), (sim_id, parts[2]), parts[3:])
+
+		if n > 4 and parts[4] != 'snapshots':
+			return self._get_record('proxies', ('sim_id', 'proxy', 'key'),
+				(sim_id, int(parts[3]), parts[4]), parts[5:])
+
+		if n > 5:
+			row = self._conn.execute(
+				'SELECT data FROM snapshots WHERE sim_id = ? AND proxy = ? AND step = ?',
+				(sim_id, int(parts[3]), int(parts[5]))
+			).fetchone()
+			return _nested_get(json.loads(row[0]), parts[6:]) if row else None
+
+		# a whole sim, its proxies or their snapshots
+		proxy = int(parts[3]) if n > 3 else None
+		sim = self._get_sims(sim_id=sim_id, proxy=proxy).get(parts[1])
+		return _nested_get(sim, parts[2:])
+
+	def _get_record(self, table, key_cols, key_vals, rest):
+		where = ' AND '.join(c + ' = ?' for c in key_cols)
+		row = self._conn.execute('SELECT value FROM ' + table + ' WHERE ' + where, key_vals).fetchone()
+		return _nested_get(json.loads(row[0]), rest) if row else None
+
+	def _get_sims(self, sim_id=None, proxy=None):
+		where, params = '', ()
+		if sim_id is not None:
+			where, params = ' WHERE sim_id = ?', (sim_id, )
+
+		sims = {}
+		for s, k, v in self._conn.execute('SELECT sim_id, key, value FROM sims' + where, params):
+			sims.setdefault(str(s), {})[k] = json.loads(v)
+
+		if proxy is not None:
+			where, params = ' WHERE sim_id = ? AND proxy = ?', (sim_id, proxy)
+
+		for s, p, k, v in self._conn.execute('SELECT sim_id, proxy, key, value FROM proxies' + where, params):
+			proxies = sims.setdefault(str(s), {}).setdefault('proxies', {})
+			proxies.setdefault(str(p), {})[k] = json.loads(v)
+
+		for s, p, t, d in self._conn.execute('SELECT sim_id, proxy, step, data FROM snapshots' + where, params):
+			proxies = sims.setdefault(str(s), {}).setdefault('proxies', {})
+			snapshots = proxies.setdefault(str(p), {}).setdefault('snapshots', {})
+			snapshots[str(t)] = json.loads(d)
+
+		return sims
@@ -0,0 +1,186 @@
+import math, threading, time
+
+class Histogram(object):
+	'''
+		A latency histogram with bounded memory, like HdrHistogram.
+		Values (in seconds) are counted in logarithmic buckets: every power of 2
+		above `lowest` is split in `sub_buckets` buckets, so percentiles have
+		a relative error below 1 / `sub_buckets` whatever the value.
+		Count, sum, min and max are exact.
+	'''
+
+	def __init__(self, lowest=1e-6, sub_buckets=16):
+		self.lowest = lowest
+		self.sub_buckets = sub_buckets
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def _index(self, value):
+		if value < self.lowest:
+			return 0
+
+		# value / lowest = m * 2 ** e, with m in [0.5, 1)
+		m, e = math.frexp(value / self.lowest)
+		return e * self.sub_buckets + int((m - 0.5) * 2 * self.sub_buckets)
+
+	def _value(self, index):
+		'''
+			The middle of the bucket.
+		'''
+		if index == 0:
+			return self.lowest
+
+		e, sub = divmod(index, self.sub_buckets)
+		m = 0.5 + (sub + 0.5) / (2.0 * self.sub_buckets)
+		return self.lowest * math.ldexp(m, e)
+
+	def record(self, value):
+		index = self._index(value)
+		with self._lock:
+			self._buckets[index] = self._buckets.get(index, 0) + 1
+			self.count += 1
+			self.sum += value
+			if self.min is None or value < self.min:
+				self.min = value
+			if self.max is None or value > self.max:
+				self.max = value
+
+	def percentile(self, q):
+		'''
+			The value below which `q` (in [0, 1]) of the values are.
+		'''
+		with self._lock:
+			if self.count == 0:
+				return None
+
+			rank = q * self.count
+			seen = 0
+			for index in sorted(self._buckets):
+				seen += self._buckets[index]
+				if seen >= rank:
+					return min(max(self._value(index), self.min), self.max)
+			return self.max
+
+class Counter(object):
+	def __init__(self):
+		self.value = 0
+		self._lock = threading.Lock()
+
+	def inc(self, n=1):
+		with self._lock:
+			self.value += n
+
+class _Timer(object):
+	def __init__(self, histogram):
+		self._histogram = histogram
+
+	def __enter__(self):
+		self._started_at = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		self._histogram.record(time.time() - self._started_at)
+		return False
+
+class Registry(object):
+	'''
+		Histograms and counters, by name and labels.
+		`render` returns all of them in the Prometheus text format.
+	'''
+	QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+	def __init__(self, prefix='oscard_'):
+		self.prefix = prefix
+		self._histograms = {}
+		self._counters = {}
+		self._lock = threading.Lock()
+
+	def _get(self, metrics, cls, name, labels):
+		key = (name, tuple(sorted(labels.items())))
+		metric = metrics.get(key)
+		if metric is None:
+			with self._lock:
+				metric = metrics.setdefault(key, cls())
+		return metric
+
+	def histogram(self, name, **labels):
+		return self._get(self._histograms, Histogram, name, labels)
+
+	def counter(self, name, **labels):
+		return self._get(self._counters, Counter, name, labels)
+
+	def timed(self, name, **labels):
+		'''
+			A context manager recording its duration in a histogram.
+		'''
+		return _Timer(self.histogram(name, **labels))
+
+	def _line(self, name, labels, value):
+		if labels:
+			name += '{' + ','.join(k + '="' + str(v) + '"' for k, v in labels) + '}'
+		return name + ' ' + repr(float(value))
+
+	def render(self):
+		lines = []
+		with self._lock:
+			histograms = sorted(self._histograms.items())
+			counters = sorted(self._counters.items())
+
+		last = None
+		for (name, labels), h in histograms:
+			name = self.prefix + name
+			if name != last:
+				lines.append('# TYPE ' + name + ' summary')
+				last = name
+
+			for q in self.QUANTILES:
+				value = h.percentile(q)
+				if value is not None:
+					lines.append(self._line(name, labels + (('quantile', q), ), value))
+			lines.append(self._line(name + '_count', labels, h.count))
+			lines.append(self._line(name + '_sum', labels, h.sum))
+
+		# a summary has no max: it is a gauge family of its own
+		for (name, labels), h in histograms:
+			name = self.prefix + name + '_max'
+			if h.max is None:
+				continue
+			if name != last:
+				lines.append('# TYPE ' + name + ' gauge')
+				last = name
+			lines.append(self._line(name, labels, h.max))
+
+		for (name, labels), c in counters:
+			name = self.prefix + name
+			if name != last:
+				lines.append('# TYPE ' + name + ' counter')
+				last = name
+			lines.append(self._line(name, labels, c.value))
+
+		return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+histogram = REGISTRY.histogram
+counter = REGISTRY.counter
+timed = REGISTRY.timed
+render = REGISTRY.render
+
+def _timed_call(fun, h):
+	def wrapped(*args, **kwargs):
+		with _Timer(h):
+			return fun(*args, **kwargs)
+	return wrapped
+
+def instrument(obj, name, methods):
+	'''
+		Records the latency of calls to `methods` of `obj`
+		(e.g. a novaclient manager) in the `api_call_seconds` histogram.
+	'''
+	for m in methods:
+		h = histogram('api_call_seconds', call=name + '.' + m)
+		setattr(obj, m, _timed_call(getattr(obj, m), h))
@@ -1,11 +1,7 @@
 from oscard import config
 config.init_conf()
 
-from bottle import route, run, request, response
 from oslo.config import cfg
-from oscard import log
-from oscard.sim import api, collector
-import urllib, urllib2
 
 proxy_opts = [
 	cfg.IntOpt(
@@ -13,29 +9,85 @@ proxy_opts = [
 		default=3000,
 		help='Oscard proxy port'
 	),
+	cfg.StrOpt(
+		name='proxy_server',
+		default='threaded',
+		choices=['threaded', 'gevent', 'wsgiref'],
+		help='How the proxy serves requests: a thread for each keep-alive connection (threaded), '
+			'on the gevent event loop (gevent, needs gevent) or one at a time (wsgiref)'
+	),
 	cfg.BoolOpt(
 		name='fake',
 		default=True,
 		help='Fake simulation or not?'
-	)
+	),
+	# the following options are used by the client
+	cfg.IntOpt(
+		name='proxy_pool_size',
+		default=10,
+		help='Keep-alive connections kept open towards each proxy'
+	),
+	cfg.FloatOpt(
+		name='proxy_timeout',
+		default=300.0,
+		help='Seconds to wait for a proxy to answer (commands are blocking!)'
+	),
+	cfg.IntOpt(
+		name='proxy_retries',
+		default=3,
+		help='Retries on connection errors (only for GET requests)'
+	),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(proxy_opts)
+
+if __name__ == '__main__' and CONF.proxy_server == 'gevent':
+	# before anything creates threads, locks or sockets
+	from gevent import monkey
+	monkey.patch_all()
+
+from bottle import route, run, request, response, ServerAdapter, BaseRequest
+from oscard import log
+from oscard.sim import api, collector, common, metrics
+from requests.adapters import HTTPAdapter
+import requests, json, threading
+
 LOG = log.get_logger(__name__)
 
-bifrost = collector.get_fb_backend()
+# /trace gets every command of a simulation at once
+# (bottle rejects bodies over 100KB by default, ~10k commands)
+BaseRequest.MEMFILE_MAX = 64 * 1024 * 1024
+
+# created by init_api, when the proxy is run
+# (the client imports this module for ProxyAPI only)
 nova_api = None
-if CONF.fake:
-	LOG.info('using FakeAPI')
-	nova_api = api.FakeAPI()
-else:
-	LOG.info('using NovaAPI')
-	nova_api = api.NovaAPI()
+open_loop = None
+broadcaster = None
+
+def init_api():
+	'''
+		Creates the api the proxy runs commands with
+		(FakeAPI or NovaAPI, see `fake`), if not created yet, and returns it.
+	'''
+	global nova_api, open_loop, broadcaster
+	if nova_api is None:
+		if CONF.fake:
+			LOG.info('using FakeAPI')
+			nova = api.FakeAPI()
+		else:
+			LOG.info('using NovaAPI')
+			nova = api.NovaAPI()
+
+		open_loop = api.OpenLoopRunner(nova)
+		broadcaster = api.SnapshotBroadcaster(nova)
+		nova.listeners.append(broadcaster.notify)
+		nova_api = nova
+	return nova_api
 
 @route('/init', method='POST')
 def init():
-	if bifrost.is_sim_running():
+	if collector.get_fb_backend().is_sim_running():
 		body = {'msg': 'Cannot init proxy while simulation is running!'}
 		status = 400
 	else:
@@ -62,12 +114,160 @@ def destroy():
 	response.status = status
 	return body
 
+@route('/teardown', method='POST')
+def teardown():
+	body, status = nova_api.teardown(**(request.json or {}))
+	response.status = status
+	return body
+
+def run_step(cmd, **kwargs):
+	'''
+		Runs a command (create, resize, destroy or nop) and returns
+		its result or failure, its duration (in seconds, on the clock
+		of the api: virtual time for the fake one), the snapshot
+		after it and the architecture.
+	'''
+	started_at = nova_api.now()
+	if cmd == 'nop':
+		nova_api.sleep(1)
+		result, status = {}, 200
+	elif cmd in ('create', 'resize', 'destroy'):
+		result, status = getattr(nova_api, cmd)(**kwargs)
+	else:
+		return {'msg': 'Unknown command ' + str(cmd)}, 400
+	duration = nova_api.now() - started_at
+
+	# where the rest of the step time goes
+	with metrics.timed('step_phase_seconds', phase='snapshot'):
+		snapshot, snapshot_status = nova_api.snapshot()
+	if snapshot_status >= 400:
+		return snapshot, snapshot_status
+
+	with metrics.timed('step_phase_seconds', phase='architecture'):
+		arch, arch_status = nova_api.architecture
+	if arch_status >= 400:
+		return arch, arch_status
+
+	failed = status >= 400
+	return {
+		'cmd': cmd,
+		'result': None if failed else result,
+		'failure': result if failed else None,
+		'duration': duration,
+		'snapshot': snapshot,
+		'architecture': arch
+	}, 200
+
+@route('/step', method='POST')
+def step():
+	kwargs = dict(request.json or {})
+	cmd = kwargs.pop('cmd', None)
+	body, status = run_step(cmd, **kwargs)
+	response.status = status
+	return body
+
+def run_trace(cmds, count=0, proxy=0):
+	'''
+		Runs a sequence of commands as the sim client would do
+		(`proxy` is the index of this proxy in the simulation),
+		yielding a JSON line for each step.
+		If there are no instances, a create is run instead of the command.
+		Once the cluster is saturated (no flavor fits anywhere), no
+		command is run until a new compute node shows up.
+	'''
+	arch, _ = nova_api.architecture
+	saturated = False
+
+	for t, cmd in enumerate(cmds):
+		if saturated:
+			new_arch, _ = nova_api.architecture
+			if len(new_arch) > len(arch):
+				saturated = False
+			arch = new_arch
+
+			if saturated:
+				yield json.dumps({'step': t, 'saturated': True, 'architecture': arch}) + '\n'
+				continue
+
+		cmd = common.command_to_run(cmd, count)
+		body, status = run_step(cmd, step=t, proxy=proxy)
+		if status >= 400:
+			yield json.dumps({'step': t, 'error': body}) + '\n'
+			return
+
+		body['step'] = t
+		arch = body['architecture']
+		failure = body['failure']
+		if failure is None:
+			count += common.DELTAS.get(cmd, 0)
+
+		if 'saturated' in body['snapshot']:
+			saturated = body['snapshot']['saturated']
+		elif failure is not None and 'No valid host' in failure.get('msg', ''):
+			saturated = True
+
+		yield json.dumps(body) + '\n'
+
+@route('/trace', method='POST')
+def trace():
+	cmds = (request.json or {}).get('cmds', [])
+	unknown = [c for c in cmds if c not in common.COMMANDS]
+	if unknown:
+		response.status = 400
+		return {'msg': 'Unknown commands ' + str(unknown)}
+
+	response.content_type = 'application/x-ndjson'
+	return run_trace(
+		cmds,
+		count=(request.json or {}).get('count', 0),
+		proxy=(request.json or {}).get('proxy', 0)
+	)
+
+@route('/submit', method='POST')
+def submit():
+	kwargs = dict(request.json or {})
+	cmd = kwargs.pop('cmd', None)
+	body, status = open_loop.submit(cmd, **kwargs)
+	response.status = status
+	return body
+
+@route('/results', method='GET')
+def results():
+	body, status = open_loop.results()
+	response.status = status
+	return body
+
 @route('/snapshot', method='GET')
 def snapshot():
 	body, status = nova_api.snapshot()
 	response.status = status
 	return body
 
+def _sse(event):
+	return 'id: ' + str(event['seq']) + '\ndata: ' + json.dumps(event) + '\n\n'
+
+def _ndjson(event):
+	return json.dumps(event) + '\n'
+
+def stream_snapshots(fmt):
+	for event in broadcaster.subscribe():
+		yield fmt(event)
+
+@route('/snapshots', method='GET')
+def snapshots():
+	'''
+		Streams a snapshot when a command completes (or every
+		`snapshot_stream_interval` seconds), as server-sent events if
+		asked for (Accept: text/event-stream), as JSON lines otherwise.
+	'''
+	if 'text/event-stream' in request.get_header('Accept', ''):
+		response.content_type = 'text/event-stream'
+		response.set_header('Cache-Control', 'no-cache')
+		return stream_snapshots(_sse)
+
+	response.content_type = 'application/x-ndjson'
+	return stream_snapshots(_ndjson)
+
 @route('/services', method='GET')
 def services():
 	body, status = nova_api.active_services()
@@ -76,7 +276,7 @@ def services():
 
 @route('/seed', method='GET')
 def seed():
-	body = {'seed': bifrost.seed}
+	body = {'seed': collector.get_fb_backend().seed}
 	response.status = 200
 	return body
 
@@ -86,6 +286,43 @@ def architecture():
 	response.status = 200
 	return body
 
+@route('/metrics', method='GET')
+def get_metrics():
+	response.content_type = 'text/plain; version=0.0.4'
+	return metrics.render()
+
+_MAX_POOLED_HOSTS = 32 # proxies we keep a pool of connections for
+_session = None
+_session_lock = threading.Lock()
+def get_session():
+	'''
+		Returns the HTTP session shared by every ProxyAPI.
+		The session keeps a pool of keep-alive connections for each host,
+		and it is safe to use it from concurrent threads.
+	'''
+	global _session
+	with _session_lock:
+		if _session is None:
+			adapter = HTTPAdapter(
+				pool_connections=_MAX_POOLED_HOSTS,
+				pool_maxsize=CONF.proxy_pool_size
+			)
+			_session = requests.Session()
+			_session.mount('http://', adapter)
+	return _session
+
+def _raise_for(resp):
+	'''
+		Raises the error of a failed response: the JSON body of the proxy,
+		or the HTTP status if the body is not JSON (e.g. an error page of
+		bottle, like '413 Request Entity Too Large').
+	'''
+	try:
+		body = resp.json()
+	except ValueError:
+		body = {'msg': str(resp.status_code) + ' ' + (resp.reason or '')}
+	raise Exception(body)
+
 class ProxyAPI(api.CRDAPI):
 	'''
 		The API to access the proxy
@@ -94,26 +331,41 @@ class ProxyAPI(api.CRDAPI):
 	def __init__(self, host):
 		self.host = host
 		self._baseurl = 'http://' + host
+		self._session = get_session()
 
-	def _send_request(self, endpoint='', method='GET', **kwargs):
-		import json, os
-		url = os.path.join(self._baseurl, endpoint)
+	def _send_request(self, endpoint='', method='GET', timeout=None, **kwargs):
+		url = self._baseurl + '/' + endpoint
+		timeout = timeout or CONF.proxy_timeout
 
 		if method == 'GET':
-			params = urllib.urlencode(kwargs)
-			req = url + '?' + params if params else url
+			# GETs are idempotent, we can safely retry them
+			attempts = CONF.proxy_retries + 1
+			req = lambda: self._session.get(url, params=kwargs, timeout=timeout)
 		else:
+			# commands are not, if the connection fails
+			# we don't know if they have been run or not
+			attempts = 1
 			data = json.dumps(kwargs)
-			req = urllib2.Request(url, data, headers={'Content-Type': 'application/json'})
+			req = lambda: self._session.post(
+				url,
+				data=data,
+				headers={'Content-Type': 'application/json'},
+				timeout=timeout
+			)
+
+		for attempt in xrange(attempts):
+			try:
+				resp = req()
+				break
+			except requests.exceptions.ConnectionError:
+				if attempt == attempts - 1:
+					raise
+				LOG.warning(self.host + ': connection error on /' + endpoint + ', retrying...')
+
+		if resp.status_code >= 400:
+			_raise_for(resp)
 
-		try:
-			response = urllib2.urlopen(req)
-			body = json.loads(response.read())
-		except urllib2.HTTPError as e:
-			body = json.loads(e.read())
-			raise Exception(body)
-		
-		return body
+		return resp.json()
 
 	def init(self, **kwargs):
 		return self._send_request('init', method='POST', **kwargs)
@@ -127,17 +379,176 @@ class ProxyAPI(api.CRDAPI):
 	def destroy(self, **kwargs):
 		return self._send_request('destroy', method='POST', **kwargs)
 
+	def teardown(self, **kwargs):
+		'''
+			Deletes every server on the proxy (see `NovaAPI.teardown`).
+			Returns the number of servers `deleted` and the ones `failed`.
+		'''
+		timeout = CONF.proxy_timeout + CONF.teardown_timeout
+		return self._send_request('teardown', method='POST', timeout=timeout, **kwargs)
+
+	def step(self, cmd, **kwargs):
+		'''
+			Runs the command and returns its result (or failure),
+			the snapshot and the architecture after it.
+		'''
+		return self._send_request('step', method='POST', cmd=cmd, **kwargs)
+
+	def trace(self, cmds, count=0, proxy=0):
+		'''
+			Uploads a sequence of commands that the proxy runs on its own.
+			Yields the result of each step as soon as the proxy streams it.
+		'''
+		resp = self._session.post(
+			self._baseurl + '/trace',
+			data=json.dumps({'cmds': cmds, 'count': count, 'proxy': proxy}),
+			headers={'Content-Type': 'application/json'},
+			timeout=CONF.proxy_timeout,
+			stream=True
+		)
+
+		if resp.status_code >= 400:
+			_raise_for(resp)
+
+		for line in resp.iter_lines():
+			if not line:
+				continue
+
+			event = json.loads(line)
+			if 'error' in event:
+				raise Exception(event['error'])
+			yield event
+
+	def submit(self, cmd, **kwargs):
+		'''
+			Open loop: the command is queued on the proxy,
+			its result will be returned by `results`.
+		'''
+		return self._send_request('submit', method='POST', cmd=cmd, **kwargs)
+
+	def results(self):
+		return self._send_request('results', method='GET')
+
 	def snapshot(self):
 		return self._send_request('snapshot', method='GET')
 
 	def services(self):
 		return self._send_request('services', method='GET')
 
+	def snapshots(self):
+		'''
+			Yields the snapshots pushed by the proxy (see `/snapshots`),
+			as dicts with `seq`, `time` and `snapshot`.
+		'''
+		resp = self._session.get(self._baseurl + '/snapshots', stream=True)
+		if resp.status_code >= 400:
+			_raise_for(resp)
+
+		# read unbuffered: a buffer would hold an event until the next ones fill it
+		for line in resp.iter_lines(chunk_size=1):
+			if line:
+				yield json.loads(line)
+
 	def seed(self):
 		return self._send_request('seed', method='GET')
 
 	def architecture(self):
 		return self._send_request('arch', method='GET')
 
+class ThreadedWSGIRefServer(ServerAdapter):
+	'''
+		The wsgiref server, with a thread for each connection:
+		a slow command doesn't block the other requests.
+		It speaks HTTP/1.1 and keeps connections open between requests,
+		so clients reuse them (responses without a Content-Length,
+		i.e. streams, close the connection at their end).
+	'''
+
+	def run(self, app):
+		from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, ServerHandler
+		from BaseHTTPServer import BaseHTTPRequestHandler
+		from SocketServer import ThreadingMixIn
+		from StringIO import StringIO
+		import socket
+
+		class Server(ThreadingMixIn, WSGIServer):
+			daemon_threads = True
+			request_queue_size = 128
+
+		class KeepAliveServerHandler(ServerHandler):
+			http_version = '1.1'
+
+			def cleanup_headers(self):
+				ServerHandler.cleanup_headers(self)
+				if 'Content-Length' not in self.headers:
+					# the end of the body is the end of the connection
+					self.request_handler.close_connection = 1
+				if self.request_handler.close_connection:
+					self.headers['Connection'] = 'close'
+
+		class KeepAliveHandler(WSGIRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def handle(self):
+				# one request after the other, until the connection is closed
+				BaseHTTPRequestHandler.handle(self)
+
+			def handle_one_request(self):
+				try:
+					self.raw_requestline = self.rfile.readline(65537)
+				except socket.error:
+					self.close_connection = 1
+					return
+
+				if not self.raw_requestline:
+					self.close_connection = 1
+					return
+
+				if len(self.raw_requestline) > 65536:
+					self.requestline = ''
+					self.request_version = ''
+					self.command = ''
+					self.send_error(414)
+					self.close_connection = 1
+					return
+
+				if not self.parse_request():
+					return
+
+				if self.headers.getheader('transfer-encoding'):
+					# we can't find the end of a chunked body
+					self.close_connection = 1
+
+				# the body is read whether the app reads it or not,
+				# the next request starts right after it
+				length = int(self.headers.getheader('content-length') or 0)
+				body = StringIO(self.rfile.read(length))
+
+				handler = KeepAliveServerHandler(
+					body, self.wfile, self.get_stderr(), self.get_environ()
+				)
+				handler.request_handler = self
+				handler.run(self.server.get_app())
+
+		handler = KeepAliveHandler
+		if self.quiet:
+			class QuietHandler(KeepAliveHandler):
+				def log_request(*args, **kw):
+					pass
+			handler = QuietHandler
+
+		make_server(self.host, self.port, app, Server, handler).serve_forever()
+
+_SERVERS = {
+	'threaded': ThreadedWSGIRefServer,
+	'gevent': 'gevent',
+	'wsgiref': 'wsgiref',
+}
+
 if __name__ == '__main__':
-	run(host='0.0.0.0', port=CONF.proxy_port)
\ No newline at end of file
+	# the backend is only needed by /init and /seed:
+	# connecting to it doesn't delay the api
+	threading.Thread(target=collector.get_fb_backend, name='fb-backend').start()
+	init_api()
+	LOG.info('serving requests with ' + CONF.proxy_server)
+	run(server=_SERVERS[CONF.proxy_server], host='0.0.0.0', port=CONF.proxy_port)
@@ -4,9 +4,10 @@ config.init_conf()
 from oslo.config import cfg
 from oscard import log
 from oscard.sim.proxy import ProxyAPI
-from oscard.sim import collector
+from oscard.sim import collector, common, trace
 from oscard import randomizer
-import webbrowser, time
+from multiprocessing.pool import ThreadPool
+import webbrowser, time, threading
 
 sim_group = cfg.OptGroup(name='sim')
 sim_opts = [
@@ -35,6 +36,26 @@ sim_opts = [
 		default=0,
 		help='NOP command weight'
 	),
+	cfg.BoolOpt(
+		name='concurrent',
+		default=False,
+		help='Run each step on all proxies at the same time'
+	),
+	cfg.BoolOpt(
+		name='single_round_trip',
+		default=True,
+		help='Run each command and get its snapshot with a single call to the proxy'
+	),
+	cfg.BoolOpt(
+		name='server_side',
+		default=False,
+		help='Upload the whole sequence of commands to proxies and let them run it'
+	),
+	cfg.StrOpt(
+		name='record_trace',
+		default='',
+		help='Record a binary trace of the simulation in this file (see bin/replay_trace)'
+	),
 	cfg.ListOpt(
 		name='proxy_hosts',
 		default=['0.0.0.0:3000', ],
@@ -47,10 +68,6 @@ CONF.register_group(sim_group)
 CONF.register_opts(sim_opts, sim_group)
 LOG = log.get_logger(__name__)
 
-proxies = [ProxyAPI(host) for host in CONF.sim.proxy_hosts]
-bifrost = collector.get_fb_backend()
-random = randomizer.get_randomizer()
-
 # Virtual classes for commands
 class BaseCommand(object):
 	'''
@@ -58,22 +75,45 @@ class BaseCommand(object):
 	'''
 	name = 'base_command'
 
-	def execute(self, proxy, count):
+	@property
+	def delta(self):
+		# how the command changes the number of instances
+		return common.DELTAS.get(self.name, 0)
+
+	def execute(self, proxy, count, context=None):
 		# invoke nova apis
-		# use context
+		# use context (the step and the proxy index)
 		# return new context
 		raise NotImplementedError
 
+	def step(self, proxy, count, context=None):
+		'''
+			Runs the command with a single call to the proxy.
+			Returns the new count, the failure (if any) and the proxy
+			response (result, duration, snapshot after the command
+			and architecture).
+		'''
+		resp = proxy.step(self.name, **(context or {}))
+		failure = resp['failure']
+
+		if failure is None:
+			count += self.delta
+			LOG.info(str(resp['result']))
+		else:
+			LOG.error(str(failure))
+
+		return count, failure, resp
+
 	class Meta:
 		abstract = True
 
 class CreateCommand(BaseCommand):
 	name = 'create'
 
-	def execute(self, proxy, count):
-		failure = None
+	def execute(self, proxy, count, context=None):
+		failure, resp = None, None
 		try:
-			resp = proxy.create()
+			resp = proxy.create(**(context or {}))
 			count += 1
 
 			LOG.info(str(resp))
@@ -81,15 +121,15 @@ class CreateCommand(BaseCommand):
 			LOG.error(str(e.message))
 			failure = e.message
 		finally:
-			return count, failure
+			return count, failure, resp
 
 class DestroyCommand(BaseCommand):
 	name = 'destroy'
 
-	def execute(self, proxy, count):
-		failure = None
+	def execute(self, proxy, count, context=None):
+		failure, resp = None, None
 		try:
-			resp = proxy.destroy()
+			resp = proxy.destroy(**(context or {}))
 			count -= 1
 
 			LOG.info(str(resp))
@@ -97,50 +137,80 @@ class DestroyCommand(BaseCommand):
 			LOG.error(str(e.message))
 			failure = e.message
 		finally:
-			return count, failure
+			return count, failure, resp
 
 class ResizeCommand(BaseCommand):
 	name = 'resize'
 
-	def execute(self, proxy, count):
-		failure = None
+	def execute(self, proxy, count, context=None):
+		failure, resp = None, None
 		try:
-			resp = proxy.resize()
+			resp = proxy.resize(**(context or {}))
 
 			LOG.info(str(resp))
 		except Exception as e:
 			LOG.error(str(e.message))
 			failure = e.message
 		finally:
-			return count, failure
+			return count, failure, resp
 
 class NOPCommand(BaseCommand):
 	name = 'nop'
 
-	def execute(self, proxy, count):
+	def execute(self, proxy, count, context=None):
 		LOG.info('NOP command, sleeping for 1 second')
 		time.sleep(1)
-		return count, None
+		return count, None, {}
 
 def main():
-	celery_ok = True
+	writer_mode = CONF.fb_writer
+	background = None
 
-	# checking if Celery is up
-	from celery.task.control import inspect
+	if writer_mode in ('auto', 'celery'):
+		# checking if Celery is up
+		try:
+			if not collector.celery_workers_up():
+				writer_mode = 'background'
+				LOG.warning('No celery worker is up. NOT using Celery')
+			else:
+				writer_mode = 'celery'
+		except:
+			writer_mode = 'background'
+			LOG.warning('RabbitMQ refused connection. NOT using Celery')
+
+	if writer_mode == 'celery':
+		run_on_bifrost = lambda method, *args: method.delay(*args)
+	elif writer_mode == 'background':
+		background = collector.BackgroundWriter()
+		run_on_bifrost = background.submit
+	else:
+		run_on_bifrost = lambda method, *args: method(*args)
+
+	LOG.info('Storing results using ' + writer_mode + ' writer')
+
+	proxies = [ProxyAPI(host) for host in CONF.sim.proxy_hosts]
+
+	def warm_up(p):
+		return p.architecture(), p.services(), p.init()
+
+	# connecting to the backend and warming up proxies
+	# don't depend on each other: all of them at the same time
+	pool = ThreadPool(len(proxies) + 1)
 	try:
-		if not inspect().stats():
-			celery_ok = False
-			LOG.warning('No celery worker is up. NOT using Celery')
-	except:
-		celery_ok = False
-		LOG.warning('RabbitMQ refused connection. NOT using Celery')
-
-	def run_on_bifrost(method, *args):
-		if celery_ok:
-			method.delay(*args)
-		else:
-			method(*args)
-
+		backend = pool.apply_async(collector.get_fb_backend)
+		warm_ups = [pool.apply_async(warm_up, (p, )) for p in proxies]
+		bifrost = backend.get()
+		warmed_up = []
+		for w in warm_ups:
+			try:
+				warmed_up.append(w.get())
+			except Exception as e:
+				LOG.error(e.message['msg'] if isinstance(e.message, dict) else str(e))
+				return
+	finally:
+		pool.close()
+
+	writer = collector.BatchWriter(bifrost, dispatch=run_on_bifrost)
 	no_steps = CONF.sim.no_t
 
 	# weights for commands
@@ -156,6 +226,7 @@ def main():
 		(NOPCommand(), NOP_WEIGHT),
 	]
 	cmds = [val for val, cnt in cmds_weighted for i in range(cnt)]
+	cmds_by_name = dict((c.name, c) for c, w in cmds_weighted)
 
 	counts = {}
 	hosts_dict = {}
@@ -174,7 +245,7 @@ def main():
 		no_failures[i] = 0
 		steps_run[i] = no_steps
 		saturation[i] = False
-		prev_architecture[i] = p.architecture()
+		prev_architecture[i], services, resp = warmed_up[i]
 		aggregates[i] = {
 			'aggr_r_vcpus': 0,
 			'aggr_r_memory_mb': 0,
@@ -183,19 +254,14 @@ def main():
 		}
 
 		hosts_dict[i] = {
-			'services': p.services(),
+			'services': services,
 			'address': p.host
 		}
 
-		# init every proxy
-		try:
-			resp = p.init()
-		except Exception as e:
-			LOG.error(e.message['msg'])
-			return
-
 		LOG.debug('Proxy inited with seed ' + str(resp['seed']))
 
+	# the seed proxies are inited with
+	rng = randomizer.get_counter_randomizer()
 	sim_id, _ = bifrost.add_sim(no_steps, hosts_dict)
 
 	# open tab in chrome
@@ -211,83 +277,234 @@ def main():
 
 	LOG.info('Simulation ID: ' + str(sim_id) + ', Steps: ' + str(no_steps))
 
-	for t in xrange(no_steps):
-		cmd = random.choice(cmds)
-		for i, p in enumerate(proxies):
+	recorder = None
+	if CONF.sim.record_trace:
+		recorder = trace.TraceWriter(CONF.sim.record_trace, seed=rng.seed)
+		LOG.info('Recording trace in ' + CONF.sim.record_trace)
+	sim_started_at = time.time()
+
+	no_instr_lock = threading.Lock()
+
+	def update_architecture(i, new_architecture):
+		writer.update_architecture(i, new_architecture)
+
+		if len(new_architecture) > len(prev_architecture[i]):
+			# this means that a node has been added.
+			# so it means that the proxy is no more saturated!
+			saturation[i] = False
+
+		prev_architecture[i] = new_architecture
+
+	def run_step(i, t, cmd):
+		p = proxies[i]
+		single_round_trip = CONF.sim.single_round_trip
+
+		if saturation[i] or not single_round_trip:
 			# update architecture
-			new_architecture = p.architecture()
-			run_on_bifrost(bifrost.update_architecture, i, new_architecture)
-
-			if len(new_architecture) > len(prev_architecture[i]):
-				# this means that a node has been added.
-				# so it means that the proxy is no more saturated!
-				saturation[i] = False
-
-			prev_architecture[i] = new_architecture
-			if saturation[i]:
-				# i-th proxy is saturated...
-				# the simulation for him is over...
-				LOG.warning(str(t) + ': proxy ' + str(p.host) + ' is saturated. No cmd will run on it.')
+			update_architecture(i, p.architecture())
+
+		if saturation[i]:
+			# i-th proxy is saturated...
+			# the simulation for him is over...
+			LOG.warning(str(t) + ': proxy ' + str(p.host) + ' is saturated. No cmd will run on it.')
+			steps_run[i] -= 1
+			return
+
+		# if there are no virtual machines... let's spawn one!
+		cmd = cmds_by_name[common.command_to_run(cmd.name, counts[i])]
+
+		LOG.info(p.host + ': ' + str(t) + ' --> ' + cmd.name)
+
+		# random choices of the command depend on step and proxy only
+		context = {'step': t, 'proxy': i}
+		started_at = time.time()
+		if single_round_trip:
+			counts[i], failure, resp = cmd.step(p, counts[i], context)
+			result, snapshot, new_architecture = resp['result'], resp['snapshot'], resp['architecture']
+			duration = resp['duration']
+		else:
+			counts[i], failure, result = cmd.execute(p, counts[i], context)
+			duration = time.time() - started_at
+			snapshot = p.snapshot()
+
+		record_trace(i, t, cmd.name, result, failure, started_at, duration)
+		record_step(i, t, cmd.name, snapshot, failure)
+
+		if single_round_trip:
+			# the architecture after the command,
+			# it will be checked again before the next one
+			update_architecture(i, new_architecture)
+
+	def record_trace(i, t, cmd_name, result, failure, started_at, duration):
+		if recorder is None:
+			return
+
+		# the server and flavor are in the result (or in the failure)
+		details = result if failure is None else failure
+		if not isinstance(details, dict):
+			details = {}
+
+		recorder.record(
+			i, t, cmd_name, failure,
+			details.get('flavor_id'), details.get('id'),
+			started_at - sim_started_at, duration
+		)
+
+	def record_step(i, t, cmd_name, snapshot, failure):
+		# increment number of c/r/d
+		with no_instr_lock:
+			no_instr['no_' + cmd_name] += 1
+			no_instr_now = dict(no_instr)
+
+		if failure is not None:
+			no_failures[i] += 1
+			snapshot['failure'] = failure
+			writer.update_no_failures(i, no_failures[i])
+
+		if 'saturated' in snapshot:
+			# no flavor fits on any compute node: every create would fail
+			saturation[i] = snapshot['saturated']
+		elif failure is not None and 'No valid host' in failure['msg']:
+			saturation[i] = True
+
+		# create mapping between aggregates names
+		# and snapshot names
+		new_data = {
+			'aggr_r_vcpus': snapshot['avg_r_vcpus'],
+			'aggr_r_memory_mb': snapshot['avg_r_memory_mb'],
+			'aggr_r_local_gb': snapshot['avg_r_local_gb'],
+			'aggr_no_active_cmps': snapshot['no_active_cmps']
+		}
+
+		def update_aggr(key):
+			old = aggregates[i][key]
+			new = (old * t + new_data[key]) / float(t + 1)
+			aggregates[i][key] = new
+
+		update_aggr('aggr_r_vcpus')
+		update_aggr('aggr_r_memory_mb')
+		update_aggr('aggr_r_local_gb')
+		update_aggr('aggr_no_active_cmps')
+
+		# put aggregates into snapshot
+		snapshot.update(aggregates[i])
+
+		writer.add_snapshot(i, t, cmd_name, snapshot)
+		writer.update_no_instr(no_instr_now)
+
+	def run_trace(i, cmd_names):
+		'''
+			Uploads the whole sequence of commands to the i-th proxy,
+			and records the results it streams back.
+			Saturation is handled by the proxy.
+		'''
+		p = proxies[i]
+		for event in p.trace(cmd_names, proxy=i):
+			t = event['step']
+			writer.update_architecture(i, event['architecture'])
+
+			if event.get('saturated'):
+				LOG.warning(str(t) + ': proxy ' + str(p.host) + ' is saturated. No cmd was run on it.')
 				steps_run[i] -= 1
 				continue
 
-			if counts[i] <= 0:  #there are no virtual machines... let's spawn one!
-				cmd = CreateCommand()
-			
-			LOG.info(p.host + ': ' + str(t) + ' --> ' + cmd.name)
-		
-			counts[i], failure = cmd.execute(p, counts[i])
+			LOG.info(p.host + ': ' + str(t) + ' --> ' + event['cmd'])
 
-			# increment number of c/r/d
-			no_instr['no_' + cmd.name] += 1
+			failure = event['failure']
+			if failure is None:
+				counts[i] += common.DELTAS.get(event['cmd'], 0)
+				LOG.info(str(event['result']))
+			else:
+				LOG.error(str(failure))
 
-			snapshot = p.snapshot()
-			if failure is not None:
-				no_failures[i] += 1
-				snapshot['failure'] = failure
-				run_on_bifrost(bifrost.update_no_failures, i, no_failures[i])
-
-				#TODO find a better way to do this...
-				if 'No valid host' in failure['msg']:
-					saturation[i] = True
-				
-			# create mapping between aggregates names
-			# and snapshot names
-			new_data = {
-				'aggr_r_vcpus': snapshot['avg_r_vcpus'],
-				'aggr_r_memory_mb': snapshot['avg_r_memory_mb'],
-				'aggr_r_local_gb': snapshot['avg_r_local_gb'],
-				'aggr_no_active_cmps': snapshot['no_active_cmps']
-			}
-
-			def update_aggr(key):
-				old = aggregates[i][key]
-				new = (old * t + new_data[key]) / float(t + 1)
-				aggregates[i][key] = new
-
-			update_aggr('aggr_r_vcpus')
-			update_aggr('aggr_r_memory_mb')
-			update_aggr('aggr_r_local_gb')
-			update_aggr('aggr_no_active_cmps')
-
-			# put aggregates into snapshot
-			snapshot.update(aggregates[i])
-
-			run_on_bifrost(bifrost.add_snapshot, i, t, cmd.name, snapshot)
-			run_on_bifrost(bifrost.update_no_instr, no_instr)
-
-	LOG.info(p.host + ': simulation ENDED')
-	bifrost.add_end_to_current_sim(steps_run)
-
-	import time
-	for i, p in enumerate(proxies):
-		# removing all remaining instances
-		TIMEOUT = 10
-		LOG.info(p.host + ': destroying all remaining instances in ' + str(TIMEOUT) + ' seconds')
-		for t in xrange(1, TIMEOUT + 1):
-			if t % 5 == 0:
-				LOG.info(str(TIMEOUT - t) + ' seconds to destroy...')
-			time.sleep(1)
-
-		for times in xrange(counts[i]):
-			DestroyCommand().execute(p, counts[i])
\ No newline at end of file
+			duration = event['duration']
+			record_trace(i, t, event['cmd'], event['result'], failure, time.time() - duration, duration)
+			record_step(i, t, event['cmd'], event['snapshot'], failure)
+
+	pool = None
+	if CONF.sim.concurrent and len(proxies) > 1:
+		# one thread per proxy: every proxy runs its own step
+		# and we join all of them before starting the next one.
+		pool = ThreadPool(len(proxies))
+		LOG.info('Running steps concurrently on ' + str(len(proxies)) + ' proxies')
+
+	try:
+		if CONF.sim.server_side:
+			# same draws of the client-driven simulation
+			cmd_names = [c.name for c in rng.choices(cmds, xrange(no_steps), purpose='cmd')]
+			errors = []
+
+			def run_proxy_trace(i):
+				try:
+					run_trace(i, cmd_names)
+				except Exception as e:
+					LOG.error(proxies[i].host + ': trace failed: ' + str(e))
+					errors.append(e)
+
+			threads = [
+				threading.Thread(target=run_proxy_trace, args=(i, ))
+				for i in xrange(len(proxies))
+			]
+			for th in threads:
+				th.start()
+			for th in threads:
+				th.join()
+
+			if errors:
+				# the results of the simulation are partial
+				raise Exception(str(len(errors)) + ' proxies failed their trace: ' + str(errors[0]))
+			no_steps = 0
+
+		for t in xrange(no_steps):
+			cmd = rng.choice(cmds, t, purpose='cmd')
+			if pool is None:
+				for i in xrange(len(proxies)):
+					run_step(i, t, cmd)
+			else:
+				pool.map(lambda i: run_step(i, t, cmd), xrange(len(proxies)))
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+		# wait for every pending write to be stored
+		writer.flush()
+
+		# even if the simulation failed: a running one
+		# would make proxies refuse every later /init
+		LOG.info(p.host + ': simulation ENDED')
+		try:
+			writer.add_end_to_current_sim(steps_run)
+		except Exception as e:
+			LOG.error('cannot record the end of the simulation: ' + str(e))
+
+		if background is not None:
+			background.close()
+		if recorder is not None:
+			recorder.close()
+
+	# removing all remaining instances
+	TIMEOUT = 10
+	LOG.info('destroying all remaining instances in ' + str(TIMEOUT) + ' seconds')
+	for t in xrange(1, TIMEOUT + 1):
+		if t % 5 == 0:
+			LOG.info(str(TIMEOUT - t) + ' seconds to destroy...')
+		time.sleep(1)
+
+	def teardown(p):
+		try:
+			resp = p.teardown()
+		except Exception as e:
+			LOG.error(p.host + ': teardown failed: ' + str(e))
+			return
+
+		LOG.info(p.host + ': ' + str(resp['deleted']) + ' instances destroyed')
+		for failure in resp['failed']:
+			LOG.error(p.host + ': cannot destroy ' + failure['id'] + ': ' + failure['msg'])
+
+	# every proxy at the same time
+	pool = ThreadPool(len(proxies))
+	try:
+		pool.map(teardown, proxies)
+	finally:
+		pool.close()
\ No newline at end of file
@@ -0,0 +1,192 @@
+from oscard import config
+config.init_conf()
+
+from oslo.config import cfg
+from oscard import log, randomizer
+from oscard.sim import api, common, trace
+from oscard.sim.proxy import ProxyAPI
+from multiprocessing import Pool, cpu_count
+import csv, itertools, logging, random, time
+
+sweep_group = cfg.OptGroup(name='sweep')
+sweep_opts = [
+	cfg.ListOpt(
+		name='weights',
+		default=['6:2:2:0', ],
+		help='Command weights to try, as create:resize:delete:nop'
+	),
+	cfg.ListOpt(
+		name='seeds',
+		default=['1', ],
+		help='Seeds to try'
+	),
+	cfg.ListOpt(
+		name='no_t',
+		default=['100', ],
+		help='Number of steps to try'
+	),
+	cfg.IntOpt(
+		name='samples',
+		default=0,
+		help='Run this many random combinations of weights, seeds and steps (all of them if 0)'
+	),
+	cfg.IntOpt(
+		name='processes',
+		default=0,
+		help='Simulations run at the same time on the fake cluster (one per CPU if 0)'
+	),
+	cfg.ListOpt(
+		name='proxy_hosts',
+		default=[],
+		help='Run simulations on these proxies (one at a time on each). '
+			'If empty, each simulation runs on its own in-process fake cluster'
+	),
+	cfg.StrOpt(
+		name='output',
+		default='logs/sweep.csv',
+		help='CSV file of the summary table'
+	),
+]
+
+CONF = cfg.CONF
+CONF.register_group(sweep_group)
+CONF.register_opts(sweep_opts, sweep_group)
+LOG = log.get_logger(__name__)
+
+_AGGREGATES = (
+	('aggr_r_vcpus', 'avg_r_vcpus'),
+	('aggr_r_memory_mb', 'avg_r_memory_mb'),
+	('aggr_r_local_gb', 'avg_r_local_gb'),
+	('aggr_no_active_cmps', 'no_active_cmps'),
+)
+COLUMNS = (
+	'create_w', 'resize_w', 'delete_w', 'nop_w', 'seed', 'no_t',
+	'steps_run', 'saturated_at', 'failures',
+	'aggr_r_vcpus', 'aggr_r_memory_mb', 'aggr_r_local_gb', 'aggr_no_active_cmps',
+	'elapsed_time'
+)
+
+def simulate(crd, weights, seed, no_t, teardown=False):
+	'''
+		Runs a simulation on a single proxy (or in-process api, see `trace.LocalAPI`),
+		with the same rules of `run.main`: commands are drawn by step,
+		a create is run if there are no instances and the simulation
+		ends when the cluster is saturated (the snapshot says no flavor
+		fits anywhere, or a 'No valid host' if it doesn't tell).
+		NOPs don't sleep.
+		Returns a summary of the simulation.
+	'''
+	started_at = time.time()
+	rng = randomizer.CounterRandom(seed)
+	cmds = common.weighted(weights)
+	count, failures, saturated_at = 0, 0, None
+	aggregates = dict((k, 0.0) for k, s in _AGGREGATES)
+
+	crd.init(seed=seed)
+
+	t = -1
+	for t in xrange(no_t):
+		cmd = common.command_to_run(rng.choice(cmds, t, purpose='cmd'), count)
+
+		failure = None
+		if cmd != 'nop':
+			try:
+				getattr(crd, cmd)(step=t, proxy=0)
+				count += common.DELTAS.get(cmd, 0)
+			except Exception as e:
+				failure = e.message if isinstance(e.message, dict) else {'msg': str(e)}
+				failures += 1
+
+		snapshot = crd.snapshot()
+		for k, s in _AGGREGATES:
+			aggregates[k] = (aggregates[k] * t + snapshot[s]) / float(t + 1)
+
+		if 'saturated' in snapshot:
+			saturated = snapshot['saturated']
+		else:
+			saturated = failure is not None and 'No valid host' in failure.get('msg', '')
+
+		if saturated:
+			saturated_at = t
+			break
+
+	if teardown:
+		try:
+			crd.teardown()
+		except Exception as e:
+			LOG.error(str(e.message))
+
+	summary = {
+		'create_w': weights[0],
+		'resize_w': weights[1],
+		'delete_w': weights[2],
+		'nop_w': weights[3],
+		'seed': seed,
+		'no_t': no_t,
+		'steps_run': t + 1,
+		'saturated_at': saturated_at,
+		'failures': failures,
+		'elapsed_time': time.time() - started_at
+	}
+	summary.update(aggregates)
+	return summary
+
+def get_runs():
+	'''
+		The (weights, seed, no_t) of each simulation of the sweep.
+	'''
+	weights = [tuple(int(w) for w in ws.split(':')) for ws in CONF.sweep.weights]
+	seeds = [int(s) for s in CONF.sweep.seeds]
+	steps = [int(n) for n in CONF.sweep.no_t]
+
+	runs = list(itertools.product(weights, seeds, steps))
+	if 0 < CONF.sweep.samples < len(runs):
+		runs = random.Random(0).sample(runs, CONF.sweep.samples)
+	return runs
+
+def _init_worker():
+	# a line for each command of each simulation is too much
+	logging.getLogger(api.__name__).setLevel(logging.WARNING)
+
+def _run_fake(run):
+	weights, seed, no_t = run
+	return [simulate(trace.LocalAPI(api.FakeAPI()), weights, seed, no_t)]
+
+def _run_on_proxy(args):
+	host, runs = args
+	p = ProxyAPI(host)
+	return [simulate(p, weights, seed, no_t, teardown=True) for weights, seed, no_t in runs]
+
+def main():
+	runs = get_runs()
+	hosts = CONF.sweep.proxy_hosts
+
+	if hosts:
+		# a proxy runs one simulation at a time
+		tasks = [(h, runs[i::len(hosts)]) for i, h in enumerate(hosts)]
+		pool = Pool(len(hosts))
+		results = pool.imap_unordered(_run_on_proxy, tasks)
+		LOG.info('Sweeping ' + str(len(runs)) + ' simulations on ' + str(len(hosts)) + ' proxies')
+	else:
+		processes = CONF.sweep.processes or cpu_count()
+		pool = Pool(processes, initializer=_init_worker)
+		results = pool.imap_unordered(_run_fake, runs)
+		LOG.info('Sweeping ' + str(len(runs)) + ' simulations with ' + str(processes) + ' processes')
+
+	summaries = []
+	try:
+		for res in results:
+			summaries += res
+			LOG.info(str(len(summaries)) + '/' + str(len(runs)) + ' simulations done')
+	finally:
+		pool.close()
+		pool.join()
+
+	summaries.sort(key=lambda s: [s[c] for c in COLUMNS[:6]])
+	LOG.info('Sweep results:\n' + common.format_table(COLUMNS, summaries))
+
+	with open(CONF.sweep.output, 'wb') as f:
+		writer = csv.DictWriter(f, COLUMNS, extrasaction='ignore')
+		writer.writeheader()
+		writer.writerows(summaries)
+	LOG.info('Summary table stored in ' + CONF.sweep.output)
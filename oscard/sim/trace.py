@@ -0,0 +1,291 @@
+'''
+	Binary traces of simulations.
+
+	A trace starts with a header (magic, version, seed) followed by entries,
+	each one starting with a tag byte:
+		'S': a server id, as a length-prefixed UTF-8 string.
+			Server ids are referenced by their position (0, 1, ...).
+		'R': a step (proxy, step, command, outcome, flavor,
+			server reference, start and duration in seconds).
+
+	Entries are appended (and flushed) as steps run, so a trace of a crashed
+	simulation can still be read (up to the last complete entry).
+'''
+from oscard.sim.common import COMMANDS
+import collections, struct, threading, time
+
+MAGIC = 'OSCT'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBq')
+_STRING = struct.Struct('<H')
+_RECORD = struct.Struct('<HIBBBidd')
+_STRING_TAG = 'S'
+_RECORD_TAG = 'R'
+
+_CMD_CODES = dict((c, i) for i, c in enumerate(COMMANDS))
+
+OK = 0
+FAILED = 1
+NO_VALID_HOST = 2
+OUTCOMES = ('ok', 'failed', 'no valid host')
+
+Step = collections.namedtuple('Step', [
+	'proxy', 'step', 'cmd', 'outcome', 'flavor_id', 'server_id', 'start', 'duration'
+])
+
+def outcome_of(failure):
+	if failure is None:
+		return OK
+
+	msg = failure.get('msg', '') if isinstance(failure, dict) else str(failure)
+	if 'No valid host' in (msg or ''):
+		return NO_VALID_HOST
+	return FAILED
+
+class TraceWriter(object):
+	'''
+		Appends steps to a trace file. It is thread-safe.
+	'''
+
+	def __init__(self, path, seed=0):
+		self._file = open(path, 'wb')
+		self._lock = threading.Lock()
+		self._refs = {}
+		self._file.write(_HEADER.pack(MAGIC, VERSION, seed))
+
+	def _ref(self, server_id):
+		if server_id is None:
+			return -1
+
+		server_id = unicode(server_id)
+		if server_id not in self._refs:
+			data = server_id.encode('utf-8')
+			self._file.write(_STRING_TAG + _STRING.pack(len(data)) + data)
+			self._refs[server_id] = len(self._refs)
+		return self._refs[server_id]
+
+	def record(self, proxy, step, cmd, failure=None, flavor_id=None,
+			server_id=None, start=0.0, duration=0.0):
+		with self._lock:
+			ref = self._ref(server_id)
+			self._file.write(_RECORD_TAG + _RECORD.pack(
+				proxy, step, _CMD_CODES[cmd], outcome_of(failure),
+				flavor_id or 0, ref, start, duration
+			))
+			# a step is one write, a crash loses none of them
+			self._file.flush()
+
+	def flush(self):
+		with self._lock:
+			self._file.flush()
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+class TraceReader(object):
+	'''
+		Iterates over the steps of a trace file.
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			magic, self.version, self.seed = _HEADER.unpack(f.read(_HEADER.size))
+
+		if magic != MAGIC:
+			raise Exception(path + ' is not an oscard trace')
+
+	def __iter__(self):
+		servers = []
+		with open(self.path, 'rb') as f:
+			f.seek(_HEADER.size)
+			while True:
+				tag = f.read(1)
+				if tag == _STRING_TAG:
+					data = f.read(_STRING.size)
+					if len(data) < _STRING.size:
+						return
+					length, = _STRING.unpack(data)
+					servers.append(f.read(length).decode('utf-8'))
+				elif tag == _RECORD_TAG:
+					data = f.read(_RECORD.size)
+					if len(data) < _RECORD.size:
+						return
+					proxy, step, cmd, outcome, flavor_id, ref, start, duration = _RECORD.unpack(data)
+					yield Step(
+						proxy, step, COMMANDS[cmd], outcome,
+						flavor_id or None, servers[ref] if ref >= 0 else None,
+						start, duration
+					)
+				else:
+					# EOF (or a truncated entry)
+					return
+
+class LocalAPI(object):
+	'''
+		Makes an in-process api (FakeAPI or NovaAPI) behave like ProxyAPI:
+		calls return their body, or raise it on failure.
+	'''
+
+	def __init__(self, api):
+		self._api = api
+
+	def _call(self, cmd, **kwargs):
+		body, status = getattr(self._api, cmd)(**kwargs)
+		if status >= 400:
+			raise Exception(body)
+		return body
+
+	def init(self, **kwargs):
+		return self._call('init', **kwargs)
+
+	def create(self, **kwargs):
+		return self._call('create', **kwargs)
+
+	def resize(self, **kwargs):
+		return self._call('resize', **kwargs)
+
+	def destroy(self, **kwargs):
+		return self._call('destroy', **kwargs)
+
+	def teardown(self, **kwargs):
+		return self._call('teardown', **kwargs)
+
+	def snapshot(self):
+		return self._call('snapshot')
+
+	def now(self):
+		return self._api.now()
+
+	def architecture(self):
+		body, status = self._api.architecture
+		if status >= 400:
+			raise Exception(body)
+		return body
+
+class Replayer(object):
+	'''
+		Replays the steps of a trace, with the same commands on the same
+		flavors and servers (recorded server ids are mapped to the ones
+		created during the replay).
+		Each recorded proxy is replayed on its api (in `apis`), on its own thread.
+
+		If `speed` is None steps run as fast as possible, otherwise each one
+		starts at its recorded start divided by `speed` (1.0 is real time).
+		Durations are measured with the clock of the api if it has one
+		(`now`, virtual for FakeAPI), as the proxy does, with the wall clock otherwise.
+		If `recorder` (a TraceWriter) is given, the replay is recorded too.
+	'''
+
+	def __init__(self, apis, speed=None, recorder=None):
+		self.apis = apis
+		self.speed = speed
+		self.recorder = recorder
+
+	def replay(self, steps):
+		'''
+			Returns a list of (recorded step, replayed step), ordered by step and proxy.
+		'''
+		by_proxy = collections.defaultdict(list)
+		for s in steps:
+			by_proxy[s.proxy].append(s)
+
+		missing = [p for p in by_proxy if p not in self.apis]
+		if missing:
+			raise Exception('No api for proxies ' + str(missing))
+
+		results = []
+		lock = threading.Lock()
+		started_at = time.time()
+
+		def run(proxy):
+			for recorded, replayed in self._replay_proxy(proxy, by_proxy[proxy], started_at):
+				with lock:
+					results.append((recorded, replayed))
+
+		threads = [threading.Thread(target=run, args=(p, )) for p in by_proxy]
+		for th in threads:
+			th.start()
+		for th in threads:
+			th.join()
+
+		results.sort(key=lambda r: (r[0].step, r[0].proxy))
+		return results
+
+	def _replay_proxy(self, proxy, steps, started_at):
+		api = self.apis[proxy]
+		clock = getattr(api, 'now', time.time)
+		servers = {}
+
+		for s in steps:
+			if self.speed is not None:
+				delay = started_at + s.start / self.speed - time.time()
+				if delay > 0:
+					time.sleep(delay)
+
+			kwargs = {}
+			if s.cmd in ('create', 'resize') and s.flavor_id is not None:
+				kwargs['flavor_id'] = s.flavor_id
+			if s.cmd in ('resize', 'destroy'):
+				kwargs['server_id'] = servers.get(s.server_id, s.server_id)
+
+			start, api_start = time.time(), clock()
+			failure, body = None, {}
+			if s.cmd in ('resize', 'destroy') and s.server_id is None:
+				# no server was found when recording
+				failure = body = {'msg': 'No server in trace'}
+			elif s.cmd != 'nop':
+				try:
+					body = getattr(api, s.cmd)(**kwargs)
+				except Exception as e:
+					failure = e.message if isinstance(e.message, dict) else {'msg': str(e)}
+					body = failure
+			duration = clock() - api_start
+
+			server_id = body.get('id')
+			if s.cmd == 'create' and s.server_id is not None and server_id is not None:
+				servers[s.server_id] = server_id
+			elif s.cmd == 'destroy' and failure is None:
+				servers.pop(s.server_id, None)
+
+			replayed = Step(
+				proxy, s.step, s.cmd, outcome_of(failure),
+				body.get('flavor_id', kwargs.get('flavor_id')), server_id,
+				start - started_at, duration
+			)
+
+			if self.recorder is not None:
+				self.recorder.record(
+					proxy, s.step, s.cmd, failure, replayed.flavor_id,
+					server_id, replayed.start, duration
+				)
+
+			yield s, replayed
+
+def compare(results):
+	'''
+		Summarizes `Replayer.replay` results by command:
+		number of steps, steps with a different outcome
+		and mean recorded and replayed durations.
+	'''
+	summary = {}
+	for recorded, replayed in results:
+		s = summary.setdefault(recorded.cmd, {
+			'steps': 0,
+			'mismatches': 0,
+			'recorded_duration': 0.0,
+			'replayed_duration': 0.0
+		})
+		s['steps'] += 1
+		if recorded.outcome != replayed.outcome:
+			s['mismatches'] += 1
+		s['recorded_duration'] += recorded.duration
+		s['replayed_duration'] += replayed.duration
+
+	for s in summary.values():
+		s['recorded_duration'] /= s['steps']
+		s['replayed_duration'] /= s['steps']
+
+	return summary
@@ -0,0 +1,378 @@
+from oscard import config
+config.init_conf()
+
+from oslo.config import cfg
+from oscard import log, randomizer
+from oscard.sim import common
+from oscard.sim.proxy import ProxyAPI
+import csv, math, threading, time
+
+workload_group = cfg.OptGroup(name='workload')
+workload_opts = [
+	cfg.StrOpt(
+		name='arrivals',
+		default='poisson',
+		choices=['constant', 'poisson', 'diurnal'],
+		help='How commands arrive: at a constant rate, as a Poisson process, '
+			'or as a Poisson process whose rate follows a daily cycle'
+	),
+	cfg.ListOpt(
+		name='rates',
+		default=['1.0', ],
+		help='Offered loads to try (commands per second, the peak one for diurnal arrivals)'
+	),
+	cfg.FloatOpt(
+		name='duration',
+		default=60.0,
+		help='Seconds of arrivals for each rate'
+	),
+	cfg.FloatOpt(
+		name='period',
+		default=600.0,
+		help='Seconds of a diurnal cycle (the rate goes from the trough to the peak and back)'
+	),
+	cfg.FloatOpt(
+		name='trough',
+		default=0.2,
+		help='Rate at the bottom of a diurnal cycle, as a fraction of the peak rate'
+	),
+	cfg.FloatOpt(
+		name='window',
+		default=0.0,
+		help='Summarize results by windows of this many seconds of arrivals (whole runs if 0)'
+	),
+	cfg.IntOpt(
+		name='seed',
+		default=0,
+		help='Seed of arrivals and commands'
+	),
+	cfg.ListOpt(
+		name='proxy_hosts',
+		default=['0.0.0.0:3000', ],
+		help='Proxies commands are submitted to (round robin)'
+	),
+	cfg.FloatOpt(
+		name='poll_interval',
+		default=0.5,
+		help='Seconds between polls of the results of submitted commands'
+	),
+	cfg.BoolOpt(
+		name='teardown',
+		default=True,
+		help='Destroy every instance after each rate'
+	),
+	cfg.StrOpt(
+		name='output',
+		default='logs/workload.csv',
+		help='CSV file of the summary table'
+	),
+	cfg.StrOpt(
+		name='ops_output',
+		default='logs/workload_ops.csv',
+		help='CSV file with a row for each command'
+	),
+]
+
+CONF = cfg.CONF
+CONF.register_group(workload_group)
+CONF.register_opts(workload_opts, workload_group)
+# the command mix is the one of simulations
+CONF.import_group('sim', 'oscard.sim.run')
+LOG = log.get_logger(__name__)
+
+COLUMNS = (
+	'arrivals', 'rate', 'window_start', 'offered', 'submitted', 'rejected',
+	'completed', 'failures', 'throughput',
+	'queue_delay_mean', 'queue_delay_p95',
+	'service_time_mean', 'service_time_p50', 'service_time_p95', 'service_time_p99'
+)
+OP_COLUMNS = (
+	'rate', 'op', 'proxy', 'cmd', 'scheduled_at', 'submitted_at', 'status',
+	'submit_lag', 'proxy_queue_time', 'queue_delay', 'service_time', 'msg'
+)
+
+def arrival_times(kind, rate, duration, rng, period=None, trough=None):
+	'''
+		The arrival times (seconds from the start) in [0, duration).
+		- constant: every 1 / rate seconds
+		- poisson: exponential interarrival times, with mean 1 / rate
+		- diurnal: Poisson arrivals whose rate goes from `trough` * rate
+			(at the start of every `period`) to rate (in the middle) and back.
+			They are drawn by thinning Poisson arrivals at the peak rate.
+		Draws come from `rng` (a `randomizer.CounterRandom`),
+		so the same seed gives the same arrivals.
+	'''
+	if rate <= 0:
+		return []
+
+	if kind == 'constant':
+		return [n / rate for n in xrange(int(math.ceil(duration * rate)))]
+
+	period = period or CONF.workload.period
+	trough = CONF.workload.trough if trough is None else trough
+
+	times = []
+	t, n = 0.0, 0
+	while True:
+		t += -math.log(1.0 - rng.random(n, purpose='arrival')) / rate
+		if t >= duration:
+			return times
+
+		if kind == 'poisson':
+			times.append(t)
+		else:
+			level = trough + (1.0 - trough) * (1.0 - math.cos(2 * math.pi * t / period)) / 2
+			if rng.random(n, purpose='thinning') < level:
+				times.append(t)
+		n += 1
+
+def commands(n, weights, rng):
+	'''
+		The commands of `n` arrivals, drawn with `weights` (create, resize,
+		delete, nop) with the rules `run.main` draws the ones of steps with
+		(see `common.command_to_run`), as if every command succeeded.
+	'''
+	cmds = common.weighted(weights)
+
+	drawn = []
+	count = 0
+	for i in xrange(n):
+		cmd = common.command_to_run(rng.choice(cmds, i, purpose='cmd'), count)
+		count += common.DELTAS.get(cmd, 0)
+		drawn.append(cmd)
+	return drawn
+
+class _ResultsCollector(object):
+	'''
+		Polls the results of the commands submitted to each proxy
+		(see `/results`) and stores them in their record.
+		A command can finish before `expect` is called for it (`/results`
+		returns a result once): its result is kept until then.
+	'''
+
+	def __init__(self, proxies, interval):
+		self._proxies = proxies
+		self._interval = interval
+		self._lock = threading.Lock()
+		self._waiting = {}
+		self._orphans = {}
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='workload-results')
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+
+	def expect(self, proxy, op_id, record):
+		with self._lock:
+			res = self._orphans.pop((proxy, op_id), None)
+			if res is None:
+				self._waiting[(proxy, op_id)] = record
+			else:
+				self._store(record, res)
+
+	def _store(self, record, res):
+		body = res['body'] if isinstance(res['body'], dict) else {}
+		record['status'] = res['status']
+		record['proxy_queue_time'] = res['queue_time']
+		record['queue_delay'] = record['submit_lag'] + res['queue_time']
+		record['service_time'] = res['latency']
+		record['msg'] = body.get('msg') if res['status'] >= 400 else None
+
+	def pending(self):
+		with self._lock:
+			return len(self._waiting)
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+	def _poll(self):
+		for i, p in enumerate(self._proxies):
+			try:
+				done = p.results()['results']
+			except Exception as e:
+				LOG.error(p.host + ': cannot get results: ' + str(e))
+				continue
+
+			with self._lock:
+				for res in done:
+					record = self._waiting.pop((i, res['op_id']), None)
+					if record is None:
+						# not expected yet (or submitted by someone else)
+						self._orphans[(i, res['op_id'])] = res
+						continue
+
+					self._store(record, res)
+
+	def _run(self):
+		while not self._stopped.is_set():
+			self._poll()
+			self._stopped.wait(self._interval)
+		self._poll()
+
+def run_workload(proxies, rate, schedule):
+	'''
+		Submits the commands of `schedule` (a list of (arrival time, command))
+		to the proxies (round robin) at their arrival time, without waiting
+		for them, and waits for all of them to finish.
+		Returns a record for each command but nops.
+
+		The queueing delay of a command is the time from its arrival
+		to its start on the proxy (late submissions included),
+		its service time the time it took to run.
+	'''
+	collector = _ResultsCollector(proxies, CONF.workload.poll_interval)
+	collector.start()
+
+	records = []
+	started_at = time.time()
+	try:
+		for n, (arrival, cmd) in enumerate(schedule):
+			if cmd == 'nop':
+				continue
+
+			delay = started_at + arrival - time.time()
+			if delay > 0:
+				time.sleep(delay)
+
+			i = len(records) % len(proxies)
+			record = {
+				'rate': rate,
+				'op': n,
+				'proxy': i,
+				'cmd': cmd,
+				'scheduled_at': arrival,
+				'submitted_at': time.time() - started_at,
+				'status': None,
+				'proxy_queue_time': None,
+				'queue_delay': None,
+				'service_time': None,
+				'msg': None
+			}
+			record['submit_lag'] = record['submitted_at'] - arrival
+			records.append(record)
+
+			try:
+				resp = proxies[i].submit(cmd)
+			except Exception as e:
+				# rejected (too many pending commands) or not submitted at all
+				msg = e.message if isinstance(e.message, dict) else {'msg': str(e)}
+				record['status'] = 429 if 'Too many' in msg.get('msg', '') else 503
+				record['msg'] = msg.get('msg')
+				continue
+
+			collector.expect(i, resp['op_id'], record)
+
+		LOG.info('All commands submitted, waiting for ' + str(collector.pending()) + ' of them...')
+		deadline = time.time() + CONF.proxy_timeout
+		while collector.pending() > 0 and time.time() < deadline:
+			time.sleep(CONF.workload.poll_interval)
+
+		if collector.pending() > 0:
+			LOG.warning(str(collector.pending()) + ' commands did not finish')
+	finally:
+		collector.stop()
+
+	return records
+
+def _percentile(values, p):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def _mean(values):
+	return sum(values) / float(len(values)) if values else None
+
+def summarize(kind, rate, duration, records, offered, window_start=None):
+	'''
+		A row of the summary table for the records of a run (or of a window).
+		`offered` is the number of arrivals (nops included).
+	'''
+	finished = [r for r in records if r['service_time'] is not None]
+	failed = [r for r in finished if r['status'] >= 400]
+	# commands arrived in the window can finish after its end
+	started_at = window_start or 0.0
+	ended_at = max([r['scheduled_at'] + r['queue_delay'] + r['service_time'] for r in finished] or [0.0])
+	elapsed = max(ended_at - started_at, duration)
+	queue_delays = [r['queue_delay'] for r in finished]
+	service_times = [r['service_time'] for r in finished]
+
+	return {
+		'arrivals': kind,
+		'rate': rate,
+		'window_start': window_start,
+		'offered': offered / float(duration),
+		'submitted': len(records),
+		'rejected': len([r for r in records if r['status'] in (429, 503)]),
+		'completed': len(finished) - len(failed),
+		'failures': len(failed),
+		'throughput': (len(finished) - len(failed)) / elapsed,
+		'queue_delay_mean': _mean(queue_delays),
+		'queue_delay_p95': _percentile(queue_delays, 95),
+		'service_time_mean': _mean(service_times),
+		'service_time_p50': _percentile(service_times, 50),
+		'service_time_p95': _percentile(service_times, 95),
+		'service_time_p99': _percentile(service_times, 99),
+	}
+
+def main():
+	kind = CONF.workload.arrivals
+	duration = CONF.workload.duration
+	window = CONF.workload.window
+	weights = (CONF.sim.create_w, CONF.sim.resize_w, CONF.sim.delete_w, CONF.sim.nop_w)
+	proxies = [ProxyAPI(host) for host in CONF.workload.proxy_hosts]
+	seed = CONF.workload.seed
+
+	summaries = []
+	all_records = []
+	for rate in [float(r) for r in CONF.workload.rates]:
+		rng = randomizer.CounterRandom(seed)
+		times = arrival_times(kind, rate, duration, rng)
+		schedule = zip(times, commands(len(times), weights, rng))
+
+		for p in proxies:
+			p.init(seed=seed)
+
+		LOG.info(
+			'Offering ' + str(len(schedule)) + ' commands in ' + str(duration) + ' seconds ('
+			+ kind + ' arrivals, rate ' + str(rate) + ')'
+		)
+		records = run_workload(proxies, rate, schedule)
+		all_records += records
+
+		if window > 0:
+			for w in xrange(int(math.ceil(duration / window))):
+				start = w * window
+				end = min(start + window, duration)
+				in_window = lambda t: start <= t < end
+				summaries.append(summarize(
+					kind, rate, end - start,
+					[r for r in records if in_window(r['scheduled_at'])],
+					len([t for t in times if in_window(t)]),
+					window_start=start
+				))
+		else:
+			summaries.append(summarize(kind, rate, duration, records, len(schedule)))
+
+		if CONF.workload.teardown:
+			for p in proxies:
+				try:
+					p.teardown()
+				except Exception as e:
+					LOG.error(p.host + ': teardown failed: ' + str(e))
+
+	LOG.info('Workload results:\n' + common.format_table(COLUMNS, summaries))
+
+	with open(CONF.workload.output, 'wb') as f:
+		writer = csv.DictWriter(f, COLUMNS, extrasaction='ignore')
+		writer.writeheader()
+		writer.writerows(summaries)
+	LOG.info('Summary table stored in ' + CONF.workload.output)
+
+	with open(CONF.workload.ops_output, 'wb') as f:
+		writer = csv.DictWriter(f, OP_COLUMNS, extrasaction='ignore')
+		writer.writeheader()
+		writer.writerows(all_records)
+	LOG.info('Commands stored in ' + CONF.workload.ops_output)